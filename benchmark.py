@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+#----------------------------------------------------------------------------
+# Offline benchmark for the vision pipeline.
+#
+# Feeds stills, a recorded video or a FrameRecorder recording through the
+# GripPipeline and GripPipeline2 pipelines and the target geometry without
+# a Pi, a camera or a NetworkTables server, and reports per-stage latency,
+# frames per second, peak memory and how much the vision loop allocates per
+# frame.
+#
+#   python3 benchmark.py                           # example_grip_input.jpg
+#   python3 benchmark.py frames/ --repeat 5        # every image in frames/
+#   python3 benchmark.py match.avi --max-frames 600
+#   python3 benchmark.py vision.rec                # frames the Pi recorded
+#   python3 benchmark.py --bands 3                 # threshold and contours on 3 threads
+#   python3 benchmark.py --save-baseline baseline.json
+#   python3 benchmark.py --baseline baseline.json  # fails if a stage got slower
+#----------------------------------------------------------------------------
+
+import argparse
+import json
+import os
+import resource
+import sys
+import time
+import tracemalloc
+import types
+
+import cv2
+import numpy
+
+imageExtensions = (".jpg", ".jpeg", ".png", ".bmp")
+
+class StubTable:
+    """Stands in for a NetworkTables table; remembers what was put."""
+
+    def __init__(self):
+        self.values = {}
+
+    def putNumber(self, key, value):
+        self.values[key] = value
+        return True
+
+    def getNumber(self, key, defaultValue):
+        return self.values.get(key, defaultValue)
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+class StubNetworkTables:
+    """Stands in for NetworkTablesInstance.getDefault()."""
+
+    def __init__(self):
+        self.tables = {}
+
+    def getTable(self, name):
+        return self.tables.setdefault(name, StubTable())
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+def installStubs():
+    """Replace cscore, networktables and ntcore with local stubs, so
+    multiCameraServer can be imported on a machine without them."""
+    stub = type("Stub", (), {"__getattr__": lambda self, name: stub(),
+                             "__call__": lambda self, *args, **kwargs: stub()})
+    cscore = types.ModuleType("cscore")
+    for name in ("CameraServer", "VideoSource", "UsbCamera", "MjpegServer", "VideoCamera"):
+        setattr(cscore, name, stub())
+    networktables = types.ModuleType("networktables")
+    networktables.NetworkTablesInstance = stub()
+    ntcore = types.ModuleType("ntcore")
+    ntcore.constants = stub()
+    for module in (cscore, networktables, ntcore):
+        sys.modules.setdefault(module.__name__, module)
+
+def loadFrames(path, maxFrames):
+    """Decode every frame up front so decoding is not part of the timings."""
+    if os.path.isdir(path):
+        names = sorted(n for n in os.listdir(path) if n.lower().endswith(imageExtensions))
+        frames = [cv2.imread(os.path.join(path, n)) for n in names[:maxFrames]]
+    elif path.lower().endswith(imageExtensions):
+        frames = [cv2.imread(path)]
+    elif path.lower().endswith(".rec"):
+        import multiCameraServer as mcs
+        replay = mcs.ReplaySource(path)
+        frames = [numpy.array(replay.record(i)[0]) for i in range(min(len(replay), maxFrames))]
+    else:
+        frames = []
+        capture = cv2.VideoCapture(path)
+        while len(frames) < maxFrames:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            frames.append(frame)
+        capture.release()
+    frames = [f for f in frames if f is not None]
+    if not frames:
+        sys.exit("no frames could be read from '{}'".format(path))
+    return frames
+
+def percentile(samples, p):
+    return float(numpy.percentile(samples, p)) * 1000 if samples else 0.0
+
+def run(frames, repeat, bands=1):
+    """Time every stage over every frame, repeat times, with the pipelines split into bands.
+
+    Returns ({stage: [seconds]}, number of frames the geometry had no solution for).
+    """
+    import multiCameraServer as mcs
+    mcs.ntinst = StubNetworkTables()
+
+    # without a tracking lock, so every frame is a whole-frame search
+    # whatever order the frames are in and however often they repeat
+    grip = mcs.createPipeline(dict(mcs.pipelineDescriptions["GripPipeline"], tracking=False))
+    grip2 = mcs.createPipeline(dict(mcs.pipelineDescriptions["GripPipeline2"], tracking=False))
+    grip.bands = grip2.bands = bands
+    timings = {"GripPipeline": [], "GripPipeline2": [], "geometry": [], "total": [], "all candidates": []}
+    geometryErrors = 0
+    clock = time.perf_counter
+
+    for i in range(repeat):
+        for frame in frames:
+            start = clock()
+            grip.process(frame)
+            timings["GripPipeline"].append(clock() - start)
+
+            start = clock()
+            x,y,w,h,c = grip2.process(frame)
+            middle = clock()
+            if x != -1:
+                if not mcs.solveContour(x, y, w, h, c, mcs.TargetResult(0, 0, 0)).solved:
+                    geometryErrors += 1
+            end = clock()
+            timings["GripPipeline2"].append(middle - start)
+            timings["geometry"].append(end - middle)
+            timings["total"].append(end - start)
+
+            # every candidate the select step kept, solved in one call
+            if grip2.filter_contours_output:
+                left, right = mcs.contourKeypoints(grip2.filter_contours_output)
+                start = clock()
+                mcs.solvePoints(left, right)
+                timings["all candidates"].append(clock() - start)
+    return timings, geometryErrors
+
+def allocations(frames):
+    """Bytes GripPipeline2 allocates and frees again per frame, after a warm-up.
+
+    Runs untimed, since tracemalloc slows every allocation down. Returns
+    (mean transient bytes per frame, bytes still held at the end).
+    """
+    import multiCameraServer as mcs
+    grip2 = mcs.createPipeline(dict(mcs.pipelineDescriptions["GripPipeline2"], tracking=False))
+    for frame in frames[:2]:
+        grip2.process(frame)
+    tracemalloc.start()
+    transient = []
+    try:
+        held = tracemalloc.get_traced_memory()[0]
+        for frame in frames:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            grip2.process(frame)
+            transient.append(tracemalloc.get_traced_memory()[1] - before)
+        held = tracemalloc.get_traced_memory()[0] - held
+    finally:
+        tracemalloc.stop()
+    return sum(transient) / len(transient), held
+
+def summarize(timings):
+    stats = {}
+    for stage, samples in timings.items():
+        stats[stage] = {
+            "p50": percentile(samples, 50),
+            "p95": percentile(samples, 95),
+            "p99": percentile(samples, 99),
+        }
+    return stats
+
+def report(stats, timings, allocated=None, frameBytes=0):
+    print("{:<16}{:>10}{:>10}{:>10}".format("stage (ms)", "p50", "p95", "p99"))
+    for stage, s in stats.items():
+        print("{:<16}{:>10.3f}{:>10.3f}{:>10.3f}".format(stage, s["p50"], s["p95"], s["p99"]))
+    total = sum(timings["total"])
+    print("frames: {}  vision fps: {:.1f}".format(len(timings["total"]), len(timings["total"]) / total if total else 0))
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak //= 1024
+    print("peak memory: {:.1f} MiB".format(peak / 1024))
+    if allocated is not None:
+        transient, held = allocated
+        print("allocated per frame: {:.1f} KiB (~{:.2f} frame-sized buffers), {:.1f} KiB kept".format(
+            transient / 1024, transient / frameBytes if frameBytes else 0, held / 1024))
+
+def compare(stats, baseline, tolerance):
+    """Returns the stages slower than the baseline by more than tolerance."""
+    slower = []
+    for stage, s in stats.items():
+        if stage not in baseline:
+            continue
+        for key in ("p50", "p95"):
+            limit = baseline[stage][key] * (1 + tolerance)
+            if s[key] > limit:
+                slower.append("{} {}: {:.3f} ms > {:.3f} ms".format(stage, key, s[key], limit))
+    return slower
+
+def main():
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Offline vision pipeline benchmark")
+    parser.add_argument("source", nargs="?", default=os.path.join(here, "example_grip_input.jpg"),
+                        help="an image, a directory of images, a video or a .rec recording")
+    parser.add_argument("--repeat", type=int, default=20, help="passes over the frames")
+    parser.add_argument("--max-frames", type=int, default=300, help="frames to load from the source")
+    parser.add_argument("--baseline", help="fail if a stage is slower than this baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown, 0.25 = 25%%")
+    parser.add_argument("--save-baseline", help="write this run's numbers as a baseline")
+    parser.add_argument("--bands", type=int, default=1, help="horizontal bands to threshold and find contours in on threads")
+    args = parser.parse_args()
+
+    installStubs()
+    sys.path.insert(0, here)
+
+    frames = loadFrames(args.source, args.max_frames)
+    timings, geometryErrors = run(frames, args.repeat, args.bands)
+    # reset_peak is new in Python 3.9
+    allocated = allocations(frames) if hasattr(tracemalloc, "reset_peak") else None
+    stats = summarize(timings)
+    report(stats, timings, allocated, frames[0].nbytes)
+    if geometryErrors:
+        print("geometry had no solution on {} frames".format(geometryErrors))
+
+    if args.save_baseline:
+        with open(args.save_baseline, "wt", encoding="utf-8") as f:
+            json.dump(stats, f, indent=2)
+        print("baseline written to '{}'".format(args.save_baseline))
+
+    if args.baseline:
+        with open(args.baseline, "rt", encoding="utf-8") as f:
+            baseline = json.load(f)
+        slower = compare(stats, baseline, args.tolerance)
+        if slower:
+            print("slower than baseline:", file=sys.stderr)
+            for line in slower:
+                print("  " + line, file=sys.stderr)
+            sys.exit(1)
+        print("within {:.0f}% of baseline".format(args.tolerance * 100))
+
+if __name__ == "__main__":
+    main()
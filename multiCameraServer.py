@@ -6,245 +6,723 @@
 # the project.
 #----------------------------------------------------------------------------
 
+import argparse
+import collections
+import concurrent.futures
 import json
+import os
 import time
 import sys
+import traceback
 import cv2
 
 import numpy
 import math
+import heapq
+import multiprocessing
+import queue
+import threading
 from enum import Enum
 
 from cscore import CameraServer, VideoSource, UsbCamera, MjpegServer, VideoCamera
 from networktables import NetworkTablesInstance
 import ntcore
 
-class GripPipeline:
-    """
-    An OpenCV pipeline generated by GRIP.
-    """
-    
-    def __init__(self):
-        """initializes all values to presets or None if need to be set
-        """
-        print("grip setting up camera...")
-        self.__hsl_threshold_hue = [0.0, 180.0]
-        self.__hsl_threshold_saturation = [0.0, 64.5076400679117]
-        self.__hsl_threshold_luminance = [165.10791366906474, 255.0]
+class BufferPool:
+    """Scratch arrays that are reused from frame to frame, for dst= outputs.
 
-        self.hsl_threshold_output = None
-
-        print("setting countour finder...")
+    get() hands back the same memory every time it is called with the same
+    name and dtype. The memory only grows when a bigger shape is asked for.
+    A smaller shape, such as a tracking window, is a view of the start of
+    it, so a changing window size does not mean a new array. A pool
+    belongs to one thread.
+    """
 
-        self.__find_contours_input = self.hsl_threshold_output
-        self.__find_contours_external_only = False
+    def __init__(self):
+        self.__buffers = {}
+
+    def get(self, name, shape, dtype=numpy.uint8):
+        """Returns a contiguous array of shape and dtype for name; contents are undefined."""
+        size = int(numpy.prod(shape))
+        key = (name, numpy.dtype(dtype))
+        buffer = self.__buffers.get(key)
+        if buffer is None or buffer.size < size:
+            buffer = self.__buffers[key] = numpy.empty(size, dtype=dtype)
+        return buffer[:size].reshape(shape)
+
+def polygonMeasures(points, starts):
+    """Measures many closed polygons packed into one point array.
+    Args:
+        points: An (N, 2) numpy.ndarray of every polygon's points, back to back.
+        starts: The index in points where each polygon starts.
+    Returns:
+        Arrays of area and perimeter, one entry per polygon, matching
+        cv2.contourArea and cv2.arcLength(contour, True).
+    """
+    ends = numpy.append(starts[1:], len(points)) - 1
+    # each point's successor, wrapping around to close the polygon
+    following = numpy.arange(1, len(points) + 1)
+    following[ends] = starts
+    following = points[following]
+    cross = points[:, 0] * following[:, 1] - following[:, 0] * points[:, 1]
+    area = numpy.abs(numpy.add.reduceat(cross, starts)) / 2.0
+    step = following - points
+    perimeter = numpy.add.reduceat(numpy.hypot(step[:, 0], step[:, 1]), starts)
+    return area, perimeter
+
+def contourCandidates(input_contours, min_area, min_perimeter, min_width, max_width,
+                      min_height, max_height, max_vertex_count, min_vertex_count,
+                      min_ratio, max_ratio):
+    """The cheap part of filterContours: every test except solidity.
+
+    All contours are tested together with NumPy: bounding rect, vertex
+    count and ratio first, then area and perimeter for what is left.
+    Returns:
+        (indices into input_contours, their areas, their (x, y, w, h)
+        bounding rects as an N x 4 array), in input order.
+    """
+    if len(input_contours) == 0:
+        return numpy.zeros(0, dtype=numpy.intp), numpy.zeros(0), numpy.zeros((0, 4), dtype=numpy.int64)
+    counts = numpy.array([len(contour) for contour in input_contours])
+    points = numpy.concatenate(input_contours).reshape(-1, 2).astype(numpy.int64)
+    starts = numpy.cumsum(counts) - counts
+
+    # bounding rects, as cv2.boundingRect
+    low = numpy.minimum.reduceat(points, starts)
+    size = numpy.maximum.reduceat(points, starts) - low + 1
+    w = size[:, 0]
+    h = size[:, 1]
+    ratio = w / h
+    keep = ((w >= min_width) & (w <= max_width) &
+            (h >= min_height) & (h <= max_height) &
+            (counts >= min_vertex_count) & (counts <= max_vertex_count) &
+            (ratio >= min_ratio) & (ratio <= max_ratio))
+    candidates = numpy.flatnonzero(keep)
+    if len(candidates) == 0:
+        return candidates, numpy.zeros(0), numpy.zeros((0, 4), dtype=numpy.int64)
+
+    points = points[numpy.repeat(keep, counts)]
+    counts = counts[candidates]
+    area, perimeter = polygonMeasures(points, numpy.cumsum(counts) - counts)
+    keep = (area >= min_area) & (perimeter >= min_perimeter)
+    rects = numpy.hstack((low, size))[candidates[keep]]
+    return candidates[keep], area[keep], rects
+
+def rowSpans(contours, y0=0):
+    """Returns (top rows, bottom rows) of every contour as numpy arrays, less y0."""
+    if len(contours) == 0:
+        return numpy.zeros(0, dtype=numpy.int32), numpy.zeros(0, dtype=numpy.int32)
+    counts = numpy.array([len(c) for c in contours])
+    starts = numpy.cumsum(counts) - counts
+    ys = numpy.concatenate(contours)[:, 0, 1]
+    return numpy.minimum.reduceat(ys, starts) - y0, numpy.maximum.reduceat(ys, starts) - y0
+
+def passesSolidity(contour, area, solidity):
+    """The expensive filterContours test: area as a percentage of the convex hull's."""
+    hullArea = cv2.contourArea(cv2.convexHull(contour))
+    if hullArea == 0:
+        return False
+    solid = 100 * area / hullArea
+    return solidity[0] <= solid <= solidity[1]
+
+def filterContours(input_contours, min_area, min_perimeter, min_width, max_width,
+                    min_height, max_height, solidity, max_vertex_count, min_vertex_count,
+                    min_ratio, max_ratio):
+    """Filters out contours that do not meet certain criteria, cheapest test first.
+
+    contourCandidates does the cheap tests on all contours at once. Only
+    the survivors of those pay for a convex hull to check solidity.
+    Args:
+        input_contours: Contours as a list of numpy.ndarray.
+        min_area: The minimum area of a contour that will be kept.
+        min_perimeter: The minimum perimeter of a contour that will be kept.
+        min_width: Minimum width of a contour.
+        max_width: MaxWidth maximum width.
+        min_height: Minimum height.
+        max_height: Maximimum height.
+        solidity: The minimum and maximum solidity of a contour.
+        min_vertex_count: Minimum vertex Count of the contours.
+        max_vertex_count: Maximum vertex Count.
+        min_ratio: Minimum ratio of width to height.
+        max_ratio: Maximum ratio of width to height.
+    Returns:
+        Contours as a list of numpy.ndarray, in their input order.
+    """
+    candidates, area, rects = contourCandidates(input_contours, min_area, min_perimeter,
+                                                min_width, max_width, min_height, max_height,
+                                                max_vertex_count, min_vertex_count, min_ratio, max_ratio)
+    return [input_contours[c] for c, a in zip(candidates, area)
+            if passesSolidity(input_contours[c], a, solidity)]
+
+def rankContours(input_contours, min_area, min_perimeter, min_width, max_width,
+                 min_height, max_height, solidity, max_vertex_count, min_vertex_count,
+                 min_ratio, max_ratio, count, weights, expected_ratio, last_rect=None):
+    """The count best contours that pass filterContours, best first.
+
+    The score only uses what contourCandidates already measured, so the
+    candidates go into a heap by score and are popped until count of them
+    pass the solidity test; the rest never get a convex hull. Equal scores
+    keep their input order, so the pick is the same for the same frame.
+    Args:
+        input_contours, ... max_ratio: As for filterContours.
+        count: How many contours to return.
+        weights: [area, aspect, lock] weights of the score's parts, each of
+            which is between 0 and 1: area relative to the largest
+            candidate, how close width/height is to expected_ratio, and how
+            close the contour is to last_rect.
+        expected_ratio: The target's width/height.
+        last_rect: (x, y, w, h) of the last lock, or None.
+    Returns:
+        (contours, scores) as two lists.
+    """
+    candidates, area, rects = contourCandidates(input_contours, min_area, min_perimeter,
+                                                min_width, max_width, min_height, max_height,
+                                                max_vertex_count, min_vertex_count, min_ratio, max_ratio)
+    if len(candidates) == 0 or count <= 0:
+        return [], []
+    x, y, w, h = rects.T
+    ratio = w / h
+    score = weights[0] * area / max(area.max(), 1e-9)
+    score += weights[1] * numpy.minimum(ratio, expected_ratio) / numpy.maximum(ratio, expected_ratio)
+    if last_rect is not None:
+        lx, ly, lw, lh = last_rect
+        distance = numpy.hypot(x + w / 2 - lx - lw / 2, y + h / 2 - ly - lh / 2)
+        score += weights[2] / (1 + distance / max(lw, 1))
+
+    heap = list(zip((-score).tolist(), range(len(candidates))))
+    heapq.heapify(heap)
+    contours = []
+    scores = []
+    while heap and len(contours) < count:
+        negative, i = heapq.heappop(heap)
+        contour = input_contours[candidates[i]]
+        if passesSolidity(contour, area[i], solidity):
+            contours.append(contour)
+            scores.append(-negative)
+    return contours, scores
+
+# Detection pipelines, described the way GRIP lays them out: a list of steps
+# run in order. A pipeline has one or more threshold steps (a pixel in any
+# of their ranges is kept), then any number of erode/dilate steps, then
+# find_contours and filter_contours, and optionally select to keep the best
+# scoring contours (see rankContours). Every number in a step can be tuned
+# while running under the name '<step>_<key>', e.g. 'rgb_threshold_red' (or
+# '<name>_<key>' for a step with a "name", so two erode steps can be told
+# apart). "tracking", "pyramid scale" and "bands" set the VisionPipeline
+# attributes of the same names.
+pipelineDescriptions = {
+    # the first GRIP export: bright, unsaturated pixels
+    "GripPipeline": {
+        "steps": [
+            {"step": "hsl_threshold", "hue": [0.0, 180.0], "saturation": [0.0, 64.5076400679117], "luminance": [165.10791366906474, 255.0]},
+            {"step": "find_contours", "external_only": False},
+            {"step": "filter_contours", "min_area": 200.0, "min_perimeter": 100.0, "min_width": 100.0, "max_width": 1000,
+             "min_height": 0, "max_height": 1000, "solidity": [0.0, 28.692699490662132], "max_vertices": 1000000,
+             "min_vertices": 0.0, "min_ratio": 2.0, "max_ratio": 3.0},
+            {"step": "select", "count": 1, "weights": [1.0, 1.0, 0.0]},
+        ],
+    },
+    # the green LED ring; this is the one the vision loop runs
+    "GripPipeline2": {
+        "steps": [
+            {"step": "rgb_threshold", "red": [0, 43], "green": [101, 255], "blue": [61, 255]},
+            {"step": "find_contours", "external_only": False},
+            {"step": "filter_contours", "min_area": 50, "min_perimeter": 0, "min_width": 0.0, "max_width": 1000,
+             "min_height": 0, "max_height": 1000, "solidity": [0, 53], "max_vertices": 1000000,
+             "min_vertices": 0, "min_ratio": 0.0, "max_ratio": 1000},
+            {"step": "select", "count": 3, "weights": [1.0, 1.0, 2.0]},
+        ],
+        "tracking": True,
+        "pyramid scale": 2,
+    },
+}
+
+# threshold step: (the step's channels, cvtColor code or None, the
+# converted image's channel order)
+thresholdSteps = {
+    'rgb_threshold': (['red', 'green', 'blue'], None, ['blue', 'green', 'red']),
+    'hsv_threshold': (['hue', 'saturation', 'value'], cv2.COLOR_BGR2HSV, ['hue', 'saturation', 'value']),
+    'hsl_threshold': (['hue', 'luminance', 'saturation'], cv2.COLOR_BGR2HLS, ['hue', 'luminance', 'saturation']),
+}
+
+# the keys every other step takes
+stepKeys = {
+    'erode': ['kernel', 'iterations'],
+    'dilate': ['kernel', 'iterations'],
+    'find_contours': ['external_only'],
+    'filter_contours': ['min_area', 'min_perimeter', 'min_width', 'max_width', 'min_height', 'max_height',
+                        'solidity', 'max_vertices', 'min_vertices', 'min_ratio', 'max_ratio'],
+    'select': ['count', 'weights'],
+}
+
+def valueProblem(value, current):
+    """Why value can't replace current, a number or a list of numbers, or None if it can."""
+    if isinstance(current, (list, tuple)):
+        if not isinstance(value, (list, tuple)) or len(value) != len(current):
+            return "needs {} numbers".format(len(current))
+        values = value
+    elif isinstance(value, (list, tuple)):
+        return "needs a number"
+    else:
+        values = [value]
+    # bool is an int, but a switch is no size
+    if not all(isinstance(v, (int, float)) and not isinstance(v, bool) and math.isfinite(v) for v in values):
+        return "needs finite numbers"
+    return None
+
+def stepValueProblem(key, value, current):
+    """Why value can't replace current as a pipeline step's key, or None if it can."""
+    problem = valueProblem(value, current)
+    if problem is not None:
+        return problem
+    # everything but the select weights is a size, count, ratio or color
+    if key != 'weights' and min(value if isinstance(value, (list, tuple)) else [value]) < 0:
+        return "must not be negative"
+    return None
+
+class VisionPipeline:
+    """
+    An OpenCV pipeline built from a GRIP-style description (see pipelineDescriptions).
+
+    The threshold and the morphology steps after it are fused into passes
+    over one pooled mask buffer: the threshold writes the mask and each
+    morphology pass works on it in place, with runs of the same operation
+    merged into one call and erode+dilate pairs into one open or close.
+    A pipeline may start with several threshold steps, in any colour
+    spaces; a pixel inside any of their ranges is in the mask.
+    """
 
+    def __init__(self, description):
+        """Builds the pipeline; raises ValueError if the description is not valid.
+        Args:
+            description: A pipelineDescriptions entry, or one in the same form.
+        """
+        steps = [dict(step) for step in description.get("steps", [])]
+        names = [step.get("step") for step in steps]
+        if not names or names[0] not in thresholdSteps:
+            raise ValueError("a pipeline must start with one of " + ", ".join(thresholdSteps))
+        thresholds = 1
+        while thresholds < len(names) and names[thresholds] in thresholdSteps:
+            thresholds += 1
+        morphology = thresholds
+        while morphology < len(names) and names[morphology] in ('erode', 'dilate'):
+            morphology += 1
+        if names[morphology:] not in (['find_contours', 'filter_contours'], ['find_contours', 'filter_contours', 'select']):
+            raise ValueError("after the threshold and morphology a pipeline needs find_contours, filter_contours and an optional select")
+        parameters = {}
+        for step in steps:
+            name = step["step"]
+            keys = thresholdSteps[name][0] if name in thresholdSteps else stepKeys[name]
+            if sorted(k for k in step if k != "name") != sorted(keys + ["step"]):
+                raise ValueError("step '{}' needs exactly {}".format(name, ", ".join(keys)))
+            for key in keys:
+                value = step[key]
+                if key == 'external_only':
+                    problem = None if isinstance(value, bool) else "needs true or false"
+                else:
+                    # the shape a value needs: [low, high] ranges, [area, aspect, lock] weights or a number
+                    shape = [0, 0] if name in thresholdSteps or key == 'solidity' else [0, 0, 0] if key == 'weights' else 0
+                    problem = stepValueProblem(key, value, shape)
+                if problem is not None:
+                    raise ValueError("step '{}': {} {}".format(step.get("name", name), key, problem))
+                parameter = "{}_{}".format(step.get("name", name), key)
+                if parameter in parameters:
+                    raise ValueError("two steps are called '{}', give one a \"name\"".format(step.get("name", name)))
+                if not isinstance(value, bool):
+                    parameters[parameter] = (step, key)
+        for key in ("pyramid scale", "bands"):
+            value = description.get(key, 1)
+            if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+                raise ValueError("\"{}\" must be a whole number of at least 1".format(key))
+        if not isinstance(description.get("tracking", False), bool):
+            raise ValueError("\"tracking\" must be true or false")
+
+        self.description = description
+        self.__thresholds = steps[:thresholds]
+        self.__morphology = steps[thresholds:morphology]
+        self.__find_contours_step = steps[morphology]
+        self.__filter_contours_step = steps[morphology + 1]
+        self.__select = steps[morphology + 2] if len(steps) > morphology + 2 else None
+        self.__parameters = parameters
+        self.parameter_names = list(parameters)
+        # morphology passes per pyramid scale, rebuilt when a parameter changes
+        self.__passes = {}
+
+        self.__buffers = BufferPool()
+
+        # split the threshold and contour steps over this many horizontal
+        # bands, each on its own thread (OpenCV releases the GIL); bands are
+        # at least band_min_rows tall and 1 runs on the calling thread
+        self.bands = description.get("bands", 1)
+        self.band_min_rows = 32
+        self.__band_pools = []
+        self.__band_executor = None
+        self.__band_workers = 0
+
+        self.mask_output = None
         self.find_contours_output = None
-        print("setting up filter pipeline")
-        self.__filter_contours_contours = self.find_contours_output
-        self.__filter_contours_min_area = 200.0
-        self.__filter_contours_min_perimeter = 100.0
-        self.__filter_contours_min_width = 100.0
-        self.__filter_contours_max_width = 1000
-        self.__filter_contours_min_height = 0
-        self.__filter_contours_max_height = 1000
-        self.__filter_contours_solidity = [0.0, 28.692699490662132]
-        self.__filter_contours_max_vertices = 1000000
-        self.__filter_contours_min_vertices = 0.0
-        self.__filter_contours_min_ratio = 2.0
-        self.__filter_contours_max_ratio = 3.0
-
         self.filter_contours_output = None
-
-        print("completed filter pipeline setup")
-
+        self.filter_contours_scores = None
+        # (x, y, w, h, score) of each contour in filter_contours_output
+        self.targets = []
+
+        # tracking mode: once locked, only search a padded window around the
+        # last target; the window grows on every miss and after
+        # tracking_max_misses misses we go back to searching the whole frame
+        self.tracking = description.get("tracking", False)
+        self.tracking_padding = 0.5 # fraction of the last rect's size
+        self.tracking_min_padding = 16 # pixels
+        self.tracking_growth = 0.5 # extra padding fraction per miss
+        self.tracking_max_misses = 5
+
+        self.__tracking_rect = None
+        self.__tracking_misses = 0
+        self.tracking_window = None
+
+        # coarse-to-fine: 1 searches at full resolution, 2 or 4 search a
+        # downscaled frame and refine only the winner at full resolution
+        self.pyramid_scale = description.get("pyramid scale", 1)
+
+        # set to a StageStats to time each step
+        self.stats = None
+
+    def get_parameter(self, name):
+        """Returns the value of one of parameter_names."""
+        step, key = self.__parameters[name]
+        return step[key]
+
+    def set_parameter(self, name, value):
+        """Sets one of parameter_names; call between frames, not during process."""
+        step, key = self.__parameters[name]
+        step[key] = value
+        self.__passes = {}
+
+    def check_parameter(self, name, value):
+        """Returns why value can't be used for one of parameter_names, or None if it can."""
+        step, key = self.__parameters[name]
+        return stepValueProblem(key, value, step[key])
 
     def process(self, source0):
         """
         Runs the pipeline and sets all outputs to new values.
+
+        With pyramid_scale > 1 the threshold, contour and filter steps run on
+        a 1/pyramid_scale copy of the frame and full resolution is only used
+        to refine the winning contour; the copy is made with an area resize.
+        Returns:
+            (x, y, w, h, contour) of the best target, or (-1, -1, -1, -1, -1).
         """
-        # Step HSL_Threshold0:
-        self.__hsl_threshold_input = source0
-        (self.hsl_threshold_output) = self.__hsl_threshold(self.__hsl_threshold_input, self.__hsl_threshold_hue, self.__hsl_threshold_saturation, self.__hsl_threshold_luminance)
+        # Tracking window (full frame when not locked):
+        self.tracking_window = self.__tracking_window(source0.shape)
+        x0, y0, x1, y1 = self.tracking_window
+        scale = self.pyramid_scale
+
+        if scale > 1:
+            # line the window up with the coarse pixel grid
+            cx0, cy0, cx1, cy1 = x0 // scale, y0 // scale, x1 // scale, y1 // scale
+            source = cv2.resize(source0[cy0*scale:cy1*scale, cx0*scale:cx1*scale], (cx1 - cx0, cy1 - cy0), dst=self.__buffers.get('coarse', (cy1 - cy0, cx1 - cx0, 3)), interpolation=cv2.INTER_AREA)
+            offset = (cx0, cy0)
+        else:
+            source = source0[y0:y1, x0:x1]
+            offset = (x0, y0)
 
-        # Step Find_Contours0:
-        self.__find_contours_input = self.hsl_threshold_output
-        (self.find_contours_output) = self.__find_contours(self.__find_contours_input, self.__find_contours_external_only)
+        self.__threshold_contours({None: source}, scale, offset)
+
+        stats = self.stats
+        if stats is not None:
+            start = time.perf_counter()
 
         # Step Filter_Contours0:
-        self.__filter_contours_contours = self.find_contours_output
-        (self.filter_contours_output) = self.__filter_contours(self.__filter_contours_contours, self.__filter_contours_min_area, self.__filter_contours_min_perimeter, self.__filter_contours_min_width, self.__filter_contours_max_width, self.__filter_contours_min_height, self.__filter_contours_max_height, self.__filter_contours_solidity, self.__filter_contours_max_vertices, self.__filter_contours_min_vertices, self.__filter_contours_min_ratio, self.__filter_contours_max_ratio)
-        
-		#find bounding rectangles?
-        x,y,w,h=cv2.boundingRect(self.filter_contours_output[0])
-        #cv2.rectangle(img,(x,y),(x+w,y+h),(0,255,0),2)
+        # sizes shrink with the image; solidity and ratio are scale free
+        k = 1.0 / scale
+        last = self.__tracking_rect
+        if last is not None:
+            last = tuple(v * k for v in last)
+        (self.filter_contours_output, self.filter_contours_scores) = self.__filter_contours(self.find_contours_output, k, last)
+        if stats is not None:
+            stats.record('filter', time.perf_counter() - start)
+
+        if len(self.filter_contours_output) > 0:
+            if scale > 1:
+                self.filter_contours_output = [c * scale for c in self.filter_contours_output]
+                self.filter_contours_output[0] = self.__refine_contour(source0, self.filter_contours_output[0], scale)
+            self.targets = [cv2.boundingRect(c) + (score,) for c, score in zip(self.filter_contours_output, self.filter_contours_scores)]
+            x,y,w,h = self.targets[0][:4]
+            self.__tracking_rect = (x, y, w, h)
+            self.__tracking_misses = 0
+
+            return x,y,w,h, self.filter_contours_output[0]
 
-        print("got one")
-        return x,y,w,h
+        self.targets = []
+        if self.__tracking_rect is not None:
+            self.__tracking_misses += 1
+            if self.__tracking_misses > self.tracking_max_misses:
+                self.__tracking_rect = None
 
+        return -1,-1,-1,-1, -1
 
-    @staticmethod
-    def __hsl_threshold(input, hue, sat, lum):
-        """Segment an image based on hue, saturation, and luminance ranges.
-        Args:
-            input: A BGR numpy.ndarray.
-            hue: A list of two numbers the are the min and max hue.
-            sat: A list of two numbers the are the min and max saturation.
-            lum: A list of two numbers the are the min and max luminance.
+    def convert_frame(self, source0):
+        """Returns the images the threshold steps of a whole frame work on:
+        the frame at 1/pyramid_scale under None (source0 itself at 1) and
+        its colour conversions under their cvtColor codes. They are not
+        pooled, so they can be kept and passed to find_contours many times.
+        """
+        scale = self.pyramid_scale
+        if scale > 1:
+            height, width = source0.shape[0] // scale, source0.shape[1] // scale
+            source0 = cv2.resize(source0[:height * scale, :width * scale], (width, height), interpolation=cv2.INTER_AREA)
+        images = {None: source0}
+        for step in self.__thresholds:
+            conversion = thresholdSteps[step['step']][1]
+            if conversion not in images:
+                images[conversion] = cv2.cvtColor(source0, conversion)
+        return images
+
+    def find_contours(self, images):
+        """Runs only the threshold, morphology and find_contours steps, as
+        process does on a frame with no tracking lock; for trying threshold
+        parameters on frames converted once with convert_frame (see tune.py).
         Returns:
-            A black and white numpy.ndarray.
+            (mask, contours), as mask_output and find_contours_output.
         """
-        out = cv2.cvtColor(input, cv2.COLOR_BGR2HLS)
-        return cv2.inRange(out, (hue[0], lum[0], sat[0]),  (hue[1], lum[1], sat[1]))
+        self.__threshold_contours(images, self.pyramid_scale, (0, 0))
+        return self.mask_output, self.find_contours_output
 
-    @staticmethod
-    def __find_contours(input, external_only):
-        """Sets the values of pixels in a binary image to their distance to the nearest black pixel.
+    def filter_contours(self, input_contours):
+        """Runs only the filter and select steps, as process does on contours
+        found at pyramid_scale with no tracking lock; for trying filter
+        parameters on contours that were already found (see tune.py).
+        Returns:
+            (contours, scores), as filter_contours_output and filter_contours_scores.
+        """
+        return self.__filter_contours(input_contours, 1.0 / self.pyramid_scale, None)
+
+    def __threshold_contours(self, images, scale, offset):
+        """Runs the threshold, morphology and find_contours steps into
+        mask_output and find_contours_output.
         Args:
-            input: A numpy.ndarray.
-            external_only: A boolean. If true only external contours are found.
-        Return:
-            A list of numpy.ndarray where each one represents a contour.
+            images: The BGR image under None and any of its colour conversions
+                already made, under their cvtColor codes.
+            scale: The pyramid scale of the images.
+            offset: (x, y) added to every contour point.
         """
-        if(external_only):
-            mode = cv2.RETR_EXTERNAL
-        else:
-            mode = cv2.RETR_LIST
-        method = cv2.CHAIN_APPROX_SIMPLE
-        im2, contours, hierarchy =cv2.findContours(input, mode=mode, method=method)
-        return contours
+        stats = self.stats
+        if stats is not None:
+            start = time.perf_counter()
+
+        source = images[None]
+        bands = self.__band_count(source)
+        if bands > 1:
+            # Steps Threshold0, any morphology and Find_Contours0, a band per thread:
+            self.find_contours_output = self.__banded_contours(images, scale, offset, bands)
+            self.mask_output = self.__buffers.get('threshold', source.shape[:2])
+            if stats is not None:
+                stats.record('bands', time.perf_counter() - start)
+            return
+
+        # Step Threshold0 and any morphology:
+        self.mask_output = self.__mask(images, scale, 'threshold')
+        if stats is not None:
+            now = time.perf_counter()
+            stats.record('threshold', now - start)
+            start = now
 
-    @staticmethod
-    def __filter_contours(input_contours, min_area, min_perimeter, min_width, max_width,
-                        min_height, max_height, solidity, max_vertex_count, min_vertex_count,
-                        min_ratio, max_ratio):
-        """Filters out contours that do not meet certain criteria.
+        # Step Find_Contours0:
+        self.find_contours_output = self.__find_contours(self.mask_output, self.__find_contours_step['external_only'], offset)
+        if stats is not None:
+            stats.record('contours', time.perf_counter() - start)
+
+    def __tracking_window(self, shape):
+        """Returns the (x0, y0, x1, y1) region of the frame to search this time.
         Args:
-            input_contours: Contours as a list of numpy.ndarray.
-            min_area: The minimum area of a contour that will be kept.
-            min_perimeter: The minimum perimeter of a contour that will be kept.
-            min_width: Minimum width of a contour.
-            max_width: MaxWidth maximum width.
-            min_height: Minimum height.
-            max_height: Maximimum height.
-            solidity: The minimum and maximum solidity of a contour.
-            min_vertex_count: Minimum vertex Count of the contours.
-            max_vertex_count: Maximum vertex Count.
-            min_ratio: Minimum ratio of width to height.
-            max_ratio: Maximum ratio of width to height.
+            shape: The shape of the source frame.
         Returns:
-            Contours as a list of numpy.ndarray.
+            The padded window around the last lock, or the whole frame.
         """
-        output = []
-        count = 0
-        for contour in input_contours:
-            count+=1
-            x,y,w,h = cv2.boundingRect(contour)
-            if (count == 1):
-                print("Found one at x = "+str(x)+"!")
-                ntinst.getTable('SmartDashboard').putNumber('amos_x',x)
-            if (w < min_width or w > max_width):
-                continue
-            if (h < min_height or h > max_height):
-                continue
-            area = cv2.contourArea(contour)
-            if (area < min_area):
-                continue
-            if (cv2.arcLength(contour, True) < min_perimeter):
-                continue
-            hull = cv2.convexHull(contour)
-            solid = 100 * area / cv2.contourArea(hull)
-            if (solid < solidity[0] or solid > solidity[1]):
-                continue
-            if (len(contour) < min_vertex_count or len(contour) > max_vertex_count):
-                continue
-            ratio = (float)(w) / h
-            if (ratio < min_ratio or ratio > max_ratio):
-                continue
-            output.append(contour)
-        return output
-
-class GripPipeline2:
-    """
-    An OpenCV pipeline generated by GRIP.
-    """
-    
-    def __init__(self):
-        """initializes all values to presets or None if need to be set
+        height, width = shape[:2]
+        if not self.tracking or self.__tracking_rect is None:
+            return 0, 0, width, height
+        x, y, w, h = self.__tracking_rect
+        scale = self.tracking_padding + self.tracking_growth * self.__tracking_misses
+        padX = int(w * scale) + self.tracking_min_padding
+        padY = int(h * scale) + self.tracking_min_padding
+        return max(0, x - padX), max(0, y - padY), min(width, x + w + padX), min(height, y + h + padY)
+
+    def __refine_contour(self, source0, contour, scale):
+        """Re-finds a coarse contour at full resolution.
+        Args:
+            source0: The full resolution BGR frame.
+            contour: The winning coarse contour, already scaled to full-frame coordinates.
+            scale: The pyramid scale it was found at.
+        Returns:
+            The largest full resolution contour inside the coarse contour's
+            padded bounding rect, or the scaled coarse contour if none.
         """
-
-        self.__rgb_threshold_red = [0, 43]
-        self.__rgb_threshold_green = [101, 255]
-        self.__rgb_threshold_blue = [61, 255]
-
-        self.rgb_threshold_output = None
-
-        self.__find_contours_input = self.rgb_threshold_output
-        self.__find_contours_external_only = False
-
-        self.find_contours_output = None
-
-        self.__filter_contours_contours = self.find_contours_output
-        self.__filter_contours_min_area = 50
-        self.__filter_contours_min_perimeter = 0
-        self.__filter_contours_min_width = 0.0
-        self.__filter_contours_max_width = 1000
-        self.__filter_contours_min_height = 0
-        self.__filter_contours_max_height = 1000
-        self.__filter_contours_solidity = [0, 53]
-        self.__filter_contours_max_vertices = 1000000
-        self.__filter_contours_min_vertices = 0
-        self.__filter_contours_min_ratio = 0.0
-        self.__filter_contours_max_ratio = 1000
-
-        self.filter_contours_output = None
-
-
-    def process(self, source0):
+        height, width = source0.shape[:2]
+        x, y, w, h = cv2.boundingRect(contour)
+        pad = 2 * scale
+        x0, y0 = max(0, x - pad), max(0, y - pad)
+        x1, y1 = min(width, x + w + pad), min(height, y + h + pad)
+        mask = self.__mask({None: source0[y0:y1, x0:x1]}, 1, 'refine')
+        contours = self.__find_contours(mask, True, (x0, y0))
+        if len(contours) == 0:
+            return contour
+        return max(contours, key=cv2.contourArea)
+
+    def __mask(self, images, scale, buffer, pool=None):
+        """Threshold an image, then run the morphology passes on the mask in place.
+        Args:
+            images: The BGR numpy.ndarray under None and any of its colour
+                conversions already made, under their cvtColor codes.
+            scale: The pyramid scale of input, which the morphology kernels shrink by.
+            buffer: The name of the pooled buffer to write the mask into.
+            pool: The BufferPool to use, when not the pipeline's own.
+        Returns:
+            A black and white numpy.ndarray.
         """
-        Runs the pipeline and sets all outputs to new values.
+        if pool is None:
+            pool = self.__buffers
+        input = images[None]
+        mask = pool.get(buffer, input.shape[:2])
+        converted = dict(images)
+        for i, step in enumerate(self.__thresholds):
+            conversion, channels = thresholdSteps[step['step']][1:]
+            # the RGB threshold needs no conversion, inRange takes its bounds in BGR order
+            image = converted.get(conversion)
+            if image is None:
+                image = converted[conversion] = cv2.cvtColor(input, conversion, dst=pool.get('converted {}'.format(conversion), input.shape))
+            lower, upper = tuple(step[c][0] for c in channels), tuple(step[c][1] for c in channels)
+            if i == 0:
+                cv2.inRange(image, lower, upper, dst=mask)
+            else:
+                cv2.bitwise_or(mask, cv2.inRange(image, lower, upper, dst=pool.get('range', input.shape[:2])), dst=mask)
+        for operation, kernel, iterations in self.__morphology_passes(scale):
+            cv2.morphologyEx(mask, operation, kernel, dst=mask, iterations=iterations)
+        return mask
+
+    def __morphology_reach(self, scale):
+        """Returns how many rows away a pixel can change the morphology passes' result."""
+        reach = 0
+        for operation, kernel, iterations in self.__morphology_passes(scale):
+            reach += kernel.shape[0] // 2 * iterations * (2 if operation in (cv2.MORPH_OPEN, cv2.MORPH_CLOSE) else 1)
+        return reach
+
+    def __band_count(self, source):
+        """Returns how many bands to split source into, 1 for none."""
+        if self.bands <= 1 or self.__find_contours_step['external_only']:
+            # RETR_EXTERNAL needs the whole mask to tell outer contours from
+            # ones inside a hole of a contour split by a seam
+            return 1
+        return max(1, min(int(self.bands), source.shape[0] // self.band_min_rows))
+
+    def __banded_contours(self, images, scale, offset, bands):
+        """Thresholds source and finds its contours in horizontal bands on a thread pool.
+
+        A band only keeps the contours clear of the rows either side of a
+        seam. Contours touching those rows may have been cut in two, so the
+        rows they span are merged into strips and searched again in one
+        piece, which gives the same contours as searching the whole mask.
+        Args:
+            images: The BGR numpy.ndarray under None and any of its colour
+                conversions already made, under their cvtColor codes.
+            scale: The pyramid scale of the images.
+            offset: (x, y) added to every contour point.
+            bands: How many bands to split the images into.
+        Returns:
+            A list of numpy.ndarray where each one represents a contour.
         """
-        # Step RGB_Threshold0:
-        self.__rgb_threshold_input = source0
-        (self.rgb_threshold_output) = self.__rgb_threshold(self.__rgb_threshold_input, self.__rgb_threshold_red, self.__rgb_threshold_green, self.__rgb_threshold_blue)
-
-        # Step Find_Contours0:
-        self.__find_contours_input = self.rgb_threshold_output
-        (self.find_contours_output) = self.__find_contours(self.__find_contours_input, self.__find_contours_external_only)
-
-        # Step Filter_Contours0:
-        self.__filter_contours_contours = self.find_contours_output
-        (self.filter_contours_output) = self.__filter_contours(self.__filter_contours_contours, self.__filter_contours_min_area, self.__filter_contours_min_perimeter, self.__filter_contours_min_width, self.__filter_contours_max_width, self.__filter_contours_min_height, self.__filter_contours_max_height, self.__filter_contours_solidity, self.__filter_contours_max_vertices, self.__filter_contours_min_vertices, self.__filter_contours_min_ratio, self.__filter_contours_max_ratio)
-
-		#find bounding rectangles?
-        if(len(self.filter_contours_output) > 0): # if it has something
-            #print(cv2.boundingRect(self.filter_contours_output[0]))
-            x,y,w,h = cv2.boundingRect(self.filter_contours_output[0])
- 
-            return x,y,w,h, self.filter_contours_output[0]
-        
-        return -1,-1,-1,-1, -1
+        source = images[None]
+        height = source.shape[0]
+        edges = [height * i // bands for i in range(bands + 1)]
+        seams = edges[1:-1]
+        mask = self.__buffers.get('threshold', source.shape[:2])
+        reach = self.__morphology_reach(scale)
+        while len(self.__band_pools) < bands:
+            self.__band_pools.append(BufferPool())
+        if self.__band_executor is None or self.__band_workers < bands:
+            if self.__band_executor is not None:
+                self.__band_executor.shutdown()
+            self.__band_executor = concurrent.futures.ThreadPoolExecutor(max_workers=bands, thread_name_prefix="bands")
+            self.__band_workers = bands
+
+        def band(i):
+            y0, y1 = edges[i], edges[i + 1]
+            # threshold enough rows past the band for the morphology to come out as on the whole frame
+            top, bottom = max(0, y0 - reach), min(height, y1 + reach)
+            part = self.__mask({k: v[top:bottom] for k, v in images.items()}, scale, 'band', self.__band_pools[i])
+            mask[y0:y1] = part[y0 - top:y1 - top]
+            contours = self.__find_contours(mask[y0:y1], False, (offset[0], offset[1] + y0))
+            low, high = rowSpans(contours, offset[1])
+            cut = (low == y0) if i > 0 else numpy.zeros(len(contours), dtype=bool)
+            if i < bands - 1:
+                cut |= high == y1 - 1
+            whole = [contours[j] for j in numpy.flatnonzero(~cut)]
+            return whole, list(zip(low[cut].tolist(), high[cut].tolist()))
+
+        contours, spans = [], []
+        for whole, cut in self.__band_executor.map(band, range(bands)):
+            contours.extend(whole)
+            spans.extend(cut)
+
+        strips = []
+        for top, bottom in sorted(spans):
+            if strips and top <= strips[-1][1] + 1:
+                strips[-1][1] = max(strips[-1][1], bottom)
+            else:
+                strips.append([top, bottom])
+        for top, bottom in strips:
+            found = self.__find_contours(mask[top:bottom + 1], False, (offset[0], offset[1] + top))
+            low, high = rowSpans(found, offset[1])
+            # keep what touches a seam's rows; the bands already have the rest
+            touches = numpy.zeros(len(found), dtype=bool)
+            for seam in seams:
+                touches |= (low <= seam) & (high >= seam - 1)
+            contours.extend(found[j] for j in numpy.flatnonzero(touches))
+        return contours
 
-    @staticmethod
-    def __rgb_threshold(input, red, green, blue):
-        """Segment an image based on color ranges.
+    def __morphology_passes(self, scale):
+        """Returns the erode/dilate steps as few morphologyEx calls as possible.
         Args:
-            input: A BGR numpy.ndarray.
-            red: A list of two numbers the are the min and max red.
-            green: A list of two numbers the are the min and max green.
-            blue: A list of two numbers the are the min and max blue.
+            scale: The pyramid scale the passes are for.
         Returns:
-            A black and white numpy.ndarray.
+            A list of (operation, kernel, iterations).
         """
-        out = cv2.cvtColor(input, cv2.COLOR_BGR2RGB)
-        return cv2.inRange(out, (red[0], green[0], blue[0]),  (red[1], green[1], blue[1]))
+        passes = self.__passes.get(scale)
+        if passes is not None:
+            return passes
+        merged = []
+        for step in self.__morphology:
+            size = max(1, int(round(step['kernel'] / scale)))
+            operation = cv2.MORPH_ERODE if step['step'] == 'erode' else cv2.MORPH_DILATE
+            iterations = int(step['iterations'])
+            if iterations <= 0:
+                continue
+            if merged and merged[-1][:2] == [operation, size]:
+                merged[-1][2] += iterations
+            else:
+                merged.append([operation, size, iterations])
+        passes = []
+        opposite = {cv2.MORPH_ERODE: (cv2.MORPH_DILATE, cv2.MORPH_OPEN), cv2.MORPH_DILATE: (cv2.MORPH_ERODE, cv2.MORPH_CLOSE)}
+        i = 0
+        while i < len(merged):
+            operation, size, iterations = merged[i]
+            following = merged[i + 1] if i + 1 < len(merged) else None
+            if following is not None and following == [opposite[operation][0], size, iterations]:
+                operation = opposite[operation][1]
+                i += 1
+            passes.append((operation, cv2.getStructuringElement(cv2.MORPH_RECT, (size, size)), iterations))
+            i += 1
+        self.__passes[scale] = passes
+        return passes
 
     @staticmethod
-    def __find_contours(input, external_only):
+    def __find_contours(input, external_only, offset=(0, 0)):
         """Sets the values of pixels in a binary image to their distance to the nearest black pixel.
         Args:
             input: A numpy.ndarray.
             external_only: A boolean. If true only external contours are found.
+            offset: (x, y) added to every contour point, so contours found in
+                a sub-window come back in full-frame coordinates.
         Return:
             A list of numpy.ndarray where each one represents a contour.
         """
@@ -253,53 +731,29 @@ class GripPipeline2:
         else:
             mode = cv2.RETR_LIST
         method = cv2.CHAIN_APPROX_SIMPLE
-        im2, contours, hierarchy =cv2.findContours(input, mode=mode, method=method)
+        # OpenCV 3 returns (image, contours, hierarchy), OpenCV 4 (contours, hierarchy)
+        contours = cv2.findContours(input, mode=mode, method=method, offset=offset)[-2]
         return contours
 
-    @staticmethod
-    def __filter_contours(input_contours, min_area, min_perimeter, min_width, max_width,
-                        min_height, max_height, solidity, max_vertex_count, min_vertex_count,
-                        min_ratio, max_ratio):
-        """Filters out contours that do not meet certain criteria.
+    def __filter_contours(self, input_contours, k, last_rect):
+        """Filters out contours that do not meet the filter_contours step and keeps the best.
         Args:
             input_contours: Contours as a list of numpy.ndarray.
-            min_area: The minimum area of a contour that will be kept.
-            min_perimeter: The minimum perimeter of a contour that will be kept.
-            min_width: Minimum width of a contour.
-            max_width: MaxWidth maximum width.
-            min_height: Minimum height.
-            max_height: Maximimum height.
-            solidity: The minimum and maximum solidity of a contour.
-            min_vertex_count: Minimum vertex Count of the contours.
-            max_vertex_count: Maximum vertex Count.
-            min_ratio: Minimum ratio of width to height.
-            max_ratio: Maximum ratio of width to height.
+            k: How much smaller than the frame the contours are, for the size limits.
+            last_rect: The last lock's (x, y, w, h) at the contours' scale, or None.
         Returns:
-            Contours as a list of numpy.ndarray.
+            (contours, scores); best first with a select step (see
+            rankContours), otherwise in input order with scores of 0.
         """
-        output = []
-        for contour in input_contours:
-            x,y,w,h = cv2.boundingRect(contour)
-            if (w < min_width or w > max_width):
-                continue
-            if (h < min_height or h > max_height):
-                continue
-            area = cv2.contourArea(contour)
-            if (area < min_area):
-                continue
-            if (cv2.arcLength(contour, True) < min_perimeter):
-                continue
-            hull = cv2.convexHull(contour)
-            solid = 100 * area / cv2.contourArea(hull)
-            if (solid < solidity[0] or solid > solidity[1]):
-                continue
-            if (len(contour) < min_vertex_count or len(contour) > max_vertex_count):
-                continue
-            ratio = (float)(w) / h
-            if (ratio < min_ratio or ratio > max_ratio):
-                continue
-            output.append(contour)
-        return output
+        f = self.__filter_contours_step
+        limits = (input_contours, f['min_area'] * k * k, f['min_perimeter'] * k, f['min_width'] * k, f['max_width'] * k,
+                  f['min_height'] * k, f['max_height'] * k, f['solidity'], f['max_vertices'], f['min_vertices'],
+                  f['min_ratio'], f['max_ratio'])
+        if self.__select is None:
+            contours = filterContours(*limits)
+            return contours, [0.0] * len(contours)
+        return rankContours(*limits, int(self.__select['count']), self.__select['weights'],
+                            targetWidth / targetTapeHeight, last_rect)
 
 
 
@@ -334,6 +788,12 @@ class GripPipeline2:
 #                       }
 #                   ]
 #               }
+#               "calibration": {                         // optional
+#                   "camera matrix": <3x3 list, from cv2.calibrateCamera>
+#                   "distortion": <list of coefficients> // optional
+#                   "width": <calibration image width>
+#                   "height": <calibration image height>
+#               }
 #           }
 #       ]
 #       "switched cameras": [
@@ -344,6 +804,24 @@ class GripPipeline2:
 #               // if NT value is a double, it's treated as an integer index
 #           }
 #       ]
+#       "vision parameters": {                   // optional
+#           <tuning name>: <number or list of numbers>
+#       }
+#       "pipeline": <name in pipelineDescriptions, or a description> // optional
+#       "recording": {                           // optional
+#           "path": <file to record the first camera's frames to>
+#           "frames": <frames kept, the oldest are overwritten>
+#       }
+#       "log": {                                 // optional
+#           "path": <file to write the log to, as well as stderr>
+#           "level": <"debug", "info", "warning" or "error">
+#           "max bytes": <size the file is rolled over to <path>.1 at>
+#       }
+#       "debug stream": {                        // optional
+#           "width": <width of the "Rectangle" stream>
+#           "height": <height of the "Rectangle" stream>
+#           "fps": <frame rate cap, also Vision Tuning/stream fps>
+#       }
 #   }
 
 configFile = "/boot/frc.json"
@@ -355,6 +833,10 @@ server = False
 cameraConfigs = []
 switchedCameraConfigs = []
 cameras = []
+savedParameters = {}
+recordingConfig = None
+logConfig = None
+pipelineDescription = pipelineDescriptions["GripPipeline2"]
 
 def parseError(str):
     """Report parse error."""
@@ -381,6 +863,14 @@ def readCameraConfig(config):
     # stream properties
     cam.streamConfig = config.get("stream")
 
+    # lens calibration (optional)
+    cam.calibration = config.get("calibration")
+    if cam.calibration is not None:
+        for key in ("camera matrix", "width", "height"):
+            if key not in cam.calibration:
+                parseError("camera '{}': calibration has no {}".format(cam.name, key))
+                return False
+
     cam.config = config
 
     cameraConfigs.append(cam)
@@ -411,6 +901,10 @@ def readConfig():
     """Read configuration file."""
     global team
     global server
+    global recordingConfig
+    global pipelineDescription
+    global logConfig
+    global streamWidth, streamHeight, streamMaxFps
 
     # parse file
     try:
@@ -458,6 +952,56 @@ def readConfig():
             if not readSwitchedCameraConfig(camera):
                 return False
 
+    # saved vision tuning (optional)
+    if "vision parameters" in j:
+        if isinstance(j["vision parameters"], dict):
+            savedParameters.update(j["vision parameters"])
+        else:
+            parseError("vision parameters must be a JSON object")
+
+    # detection pipeline (optional)
+    if "pipeline" in j:
+        pipeline = j["pipeline"]
+        # a description is a JSON object and anything else names one; str
+        # can't be used to tell, it holds the ntmode value in here
+        if isinstance(pipeline, dict):
+            try:
+                VisionPipeline(pipeline)
+            except (ValueError, KeyError, TypeError, AttributeError) as err:
+                parseError("pipeline: {}".format(err))
+                return False
+            pipelineDescription = pipeline
+        elif pipeline in list(pipelineDescriptions):
+            pipelineDescription = pipelineDescriptions[pipeline]
+        else:
+            parseError("unknown pipeline '{}'".format(pipeline))
+            return False
+
+    # frame recording (optional)
+    if "recording" in j:
+        recordingConfig = j["recording"]
+        if not isinstance(recordingConfig, dict) or "path" not in recordingConfig:
+            parseError("recording must be a JSON object with a path")
+            return False
+
+    # logging (optional)
+    if "log" in j:
+        logConfig = j["log"]
+        if not isinstance(logConfig, dict) or logConfig.get("level", "info") not in logLevels:
+            parseError("log must be a JSON object, with a level of " + ", ".join(logLevels))
+            return False
+
+    # "Rectangle" debug stream (optional)
+    if "debug stream" in j:
+        stream = j["debug stream"]
+        if (not isinstance(stream, dict) or
+                any(valueProblem(stream.get(key, 1), 1) is not None or stream.get(key, 1) <= 0 for key in ("width", "height", "fps"))):
+            parseError("debug stream must be a JSON object, with a positive width, height and fps")
+            return False
+        streamWidth = int(stream.get("width", streamWidth))
+        streamHeight = int(stream.get("height", streamHeight))
+        streamMaxFps = stream.get("fps", streamMaxFps)
+
     return True
 
 def startCamera(config):
@@ -499,33 +1043,1689 @@ def startSwitchedCamera(config):
 
     return server
 
-# normalizes from image coords to a points on interval [-1,1]
-def normalize(resX, resY, point):
-    nx = (2/resX) * (point[0] - resX/2+.5)
-    ny = (-2/resY) * (point[1] - resY/2+.5)
-    return [nx,ny]
+class CameraModel:
+    """Maps pixels to bearing and elevation angles in degrees.
 
-if __name__ == "__main__":
-    # constants
-    resolutionX = 1280
-    resolutionY = 720
-    hfov = 70.42 # degrees
-    vfov = 43.30
-    cameraAngle = 8.32
-    cameraHeight = .58 # meters
-    targetHeight = 1.02#2.49555 # meters; top midpoint
-    targetWidth = 0.99695
+    Bearing is positive to the right of the optical axis and elevation
+    positive above it. Without lens distortion the angle of a pixel only
+    depends on its column (bearing) or row (elevation), so both come out of
+    tables built once. With distortion only the points asked about are
+    undistorted; the frame itself is never remapped.
+    """
+
+    def __init__(self, width, height, matrix, distortion=None, calibrated=False):
+        self.width = width
+        self.height = height
+        self.matrix = numpy.array(matrix, dtype=numpy.float64).reshape(3, 3)
+        self.distortion = None
+        if distortion is not None and numpy.any(distortion):
+            self.distortion = numpy.array(distortion, dtype=numpy.float64)
+        self.calibrated = calibrated
+        fx, fy = self.matrix[0, 0], self.matrix[1, 1]
+        cx, cy = self.matrix[0, 2], self.matrix[1, 2]
+        self.bearings = numpy.degrees(numpy.arctan((numpy.arange(width) - cx) / fx))
+        self.elevations = numpy.degrees(numpy.arctan((cy - numpy.arange(height)) / fy))
+
+    @classmethod
+    def fromFov(cls, width, height, hfov, vfov):
+        """An ideal pinhole camera with the given fields of view in degrees."""
+        fx = (width / 2) / math.tan(math.radians(hfov / 2))
+        fy = (height / 2) / math.tan(math.radians(vfov / 2))
+        # pixel centres, so the middle of the frame is at (width-1)/2
+        return cls(width, height, [[fx, 0, (width - 1) / 2], [0, fy, (height - 1) / 2], [0, 0, 1]])
+
+    @classmethod
+    def fromCalibration(cls, calibration, width, height):
+        """A camera from a "calibration" config object, scaled to width x height."""
+        matrix = numpy.array(calibration["camera matrix"], dtype=numpy.float64).reshape(3, 3)
+        matrix[0] *= width / calibration["width"]
+        matrix[1] *= height / calibration["height"]
+        matrix[2] = (0, 0, 1)
+        return cls(width, height, matrix, calibration.get("distortion"), calibrated=True)
+
+    def angles(self, points):
+        """Bearings and elevations of an N x 2 array of pixel points."""
+        points = numpy.asarray(points).reshape(-1, 2)
+        if self.distortion is None:
+            columns = numpy.clip(points[:, 0].astype(numpy.intp), 0, self.width - 1)
+            rows = numpy.clip(points[:, 1].astype(numpy.intp), 0, self.height - 1)
+            return self.bearings[columns], self.elevations[rows]
+        # normalised image coordinates: x/z and y/z of the ray through each point
+        ideal = cv2.undistortPoints(points.reshape(-1, 1, 2).astype(numpy.float64), self.matrix, self.distortion).reshape(-1, 2)
+        return numpy.degrees(numpy.arctan(ideal[:, 0])), numpy.degrees(numpy.arctan(-ideal[:, 1]))
+
+def loadCameraModel(calibration, width, height):
+    """The CameraModel for a camera config's calibration, or one built from
+    hfov and vfov when the camera has not been calibrated."""
+    if calibration is not None:
+        return CameraModel.fromCalibration(calibration, width, height)
+    return CameraModel.fromFov(width, height, hfov, vfov)
+
+# constants
+resolutionX = 1280
+resolutionY = 720
+hfov = 70.42 # degrees
+vfov = 43.30
+cameraAngle = 8.32
+cameraHeight = .58 # meters
+targetHeight = 1.02#2.49555 # meters; top midpoint
+targetWidth = 0.99695
+targetTapeHeight = 0.4318 # meters; height of the tape's outline, for its aspect ratio
+dh = targetHeight - cameraHeight
+#2.794
+cameraModel = loadCameraModel(None, resolutionX, resolutionY)
+
+# "Rectangle" debug stream, unless the config's "debug stream" says otherwise
+streamWidth = 640
+streamHeight = 360
+streamMaxFps = 15
+
+# constants that can be tuned while running, see setCameraConstant
+cameraConstantNames = ['hfov', 'vfov', 'cameraAngle', 'cameraHeight', 'targetHeight', 'targetWidth', 'targetTapeHeight']
+
+def setCameraConstant(name, value):
+    """Change one of cameraConstantNames; call between frames."""
+    global dh, cameraModel
+    if name not in cameraConstantNames:
+        raise KeyError(name)
+    globals()[name] = value
     dh = targetHeight - cameraHeight
-    #2.794
+    # a calibrated camera does not use the fields of view
+    if name in ('hfov', 'vfov') and not cameraModel.calibrated:
+        cameraModel = CameraModel.fromFov(cameraModel.width, cameraModel.height, hfov, vfov)
+
+def checkCameraConstant(name, value):
+    """Returns why value can't be used for one of cameraConstantNames, or None if it can."""
+    problem = valueProblem(value, globals()[name])
+    if problem is not None:
+        return problem
+    if name in ('hfov', 'vfov') and not 0 < value < 180:
+        return "must be between 0 and 180 degrees"
+    # the aspect ratio divides by these
+    if name in ('targetWidth', 'targetTapeHeight') and value <= 0:
+        return "must be positive"
+    return None
+
+class FrameRing:
+    """A small ring of preallocated frame buffers shared by the capture,
+    processing and publish stages.
+
+    The capture stage always writes into the oldest slot nobody is holding,
+    so unread frames are dropped oldest first, and readers only ever get the
+    newest committed frame. A slot stays held (and is never overwritten)
+    until every stage that took it has released it.
+    """
+
+    def __init__(self, size, shape, dtype=numpy.uint8):
+        self.buffers = [numpy.zeros(shape=shape, dtype=dtype) for i in range(size)]
+        self.frameIds = [0] * size
+        self.timestamps = [0] * size
+        self.captureTimes = [0.0] * size
+        self.__holds = [0] * size
+        self.__latest = -1
+        self.__nextId = 1
+        self.__cond = threading.Condition()
+
+    def acquireWrite(self):
+        """Reserve the oldest free slot for the capture stage and return its index."""
+        with self.__cond:
+            while True:
+                free = [i for i in range(len(self.buffers))
+                        if self.__holds[i] == 0 and i != self.__latest]
+                if free:
+                    i = min(free, key=lambda j: self.frameIds[j])
+                    self.__holds[i] += 1
+                    return i
+                self.__cond.wait()
+
+    def commitWrite(self, i, timestamp, frame=None):
+        """Publish slot i as the newest frame.
+
+        frame is what grabFrame returned; if it reallocated the buffer
+        (e.g. the camera mode changed) the new array replaces the slot's.
+        """
+        with self.__cond:
+            if frame is not None:
+                self.buffers[i] = frame
+            self.frameIds[i] = self.__nextId
+            self.__nextId += 1
+            self.timestamps[i] = timestamp
+            self.captureTimes[i] = time.perf_counter()
+            self.__latest = i
+            self.__holds[i] -= 1
+            self.__cond.notify_all()
+
+    def abortWrite(self, i):
+        """Give back a slot reserved with acquireWrite without publishing it."""
+        self.release(i)
+
+    def acquireRead(self, lastId, timeout=None):
+        """Wait for a frame newer than lastId and hold it.
+
+        Returns the slot index, or -1 on timeout.
+        """
+        with self.__cond:
+            if not self.__cond.wait_for(
+                    lambda: self.__latest != -1 and self.frameIds[self.__latest] > lastId,
+                    timeout):
+                return -1
+            i = self.__latest
+            self.__holds[i] += 1
+            return i
+
+    def hold(self, i):
+        """Add a hold on slot i for another stage; the caller must already hold it."""
+        with self.__cond:
+            self.__holds[i] += 1
+
+    def release(self, i):
+        """Drop one hold on slot i."""
+        with self.__cond:
+            self.__holds[i] -= 1
+            self.__cond.notify_all()
+
+class LatestSlot:
+    """Single-entry handoff between two stages.
+
+    put never blocks: an item the consumer has not picked up yet is
+    replaced by the newer one and handed to onDrop.
+    """
+
+    def __init__(self, onDrop=None):
+        self.__item = None
+        self.__onDrop = onDrop
+        self.__cond = threading.Condition()
+
+    def put(self, item):
+        with self.__cond:
+            dropped = self.__item
+            self.__item = item
+            self.__cond.notify()
+        if dropped is not None and self.__onDrop is not None:
+            self.__onDrop(dropped)
+
+    def get(self, timeout=None):
+        """Wait for and take the current item, or return None on timeout."""
+        with self.__cond:
+            if not self.__cond.wait_for(lambda: self.__item is not None, timeout):
+                return None
+            item = self.__item
+            self.__item = None
+            return item
+
+class TargetResult:
+    """Output of the processing stage for one frame."""
+
+    def __init__(self, slot, frameId, timestamp, captureTime=0.0):
+        self.slot = slot
+        self.frameId = frameId
+        self.timestamp = timestamp
+        self.captureTime = captureTime
+        self.found = False
+        # False when a contour was found but the geometry had no solution
+        self.solved = False
+        self.rect = None
+        self.extLeft = None
+        self.extRight = None
+        self.values = {}
+        # (x, y, w, h, score) of the best contours, best first
+        self.candidates = []
+        # True when the frame looked like the last one and its result was reused
+        self.reused = False
+
+    def reuse(self, other):
+        """Take over other's detection and solution, for a frame that looks the same."""
+        self.found = other.found
+        self.solved = other.solved
+        self.rect = other.rect
+        self.extLeft = other.extLeft
+        self.extRight = other.extRight
+        self.values = other.values
+        self.candidates = other.candidates
+        self.reused = True
+
+class ChangeGate:
+    """Tells whether a frame looks the same as the last one that was fully
+    processed, so its result can be used again.
+
+    Frames are compared as small thumbnails: every 4th pixel in each
+    direction, averaged over 4x4 blocks, so each thumbnail cell covers
+    16x16 pixels and sensor noise averages out. A frame is unchanged when
+    no cell differs by more than threshold. The comparison is always with
+    the last processed frame, not the previous one, so a slow drift still
+    adds up to a change, and after maxReuse reused frames in a row the
+    next one is processed anyway.
+    """
+
+    def __init__(self, threshold=8, maxReuse=15):
+        # 0 turns the gate off
+        self.threshold = threshold
+        self.maxReuse = maxReuse
+        self.reused = 0
+        self.__buffers = BufferPool()
+        self.__reference = None
+
+    def unchanged(self, frame):
+        """True if frame can reuse the last result; otherwise frame becomes the reference."""
+        # a nearest resize samples without the copy a strided view would need
+        height, width = frame.shape[0] // 4, frame.shape[1] // 4
+        sampled = cv2.resize(frame, (width, height), dst=self.__buffers.get('sampled', (height, width) + frame.shape[2:]), interpolation=cv2.INTER_NEAREST)
+        height, width = height // 4, width // 4
+        thumbnail = cv2.resize(sampled, (width, height), dst=self.__buffers.get('thumbnail', (height, width) + frame.shape[2:]), interpolation=cv2.INTER_AREA)
+        reference = self.__reference
+        if (self.threshold > 0 and self.reused < self.maxReuse and
+                reference is not None and reference.shape == thumbnail.shape):
+            difference = cv2.absdiff(thumbnail, reference, dst=self.__buffers.get('difference', thumbnail.shape))
+            if difference.max() <= self.threshold:
+                self.reused += 1
+                return True
+        self.reused = 0
+        self.__reference = self.__buffers.get('reference', thumbnail.shape)
+        self.__reference[...] = thumbnail
+        return False
+
+    def reset(self):
+        """Forget the reference, so the next frame is processed; call when the pipeline changes."""
+        self.reused = 0
+        self.__reference = None
+
+class StageStats:
+    """Rolling timing samples for each stage of the vision loop.
+
+    record() is cheap enough to leave on in the hot path; summaries are
+    only worked out when they are published, a few times a second.
+    """
+
+    def __init__(self, window=128):
+        self.window = window
+        self.__samples = {}
+        self.__counts = {}
+        self.__lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        """Add one sample, in seconds, for stage."""
+        with self.__lock:
+            samples = self.__samples.get(stage)
+            if samples is None:
+                samples = self.__samples[stage] = numpy.zeros(self.window)
+                self.__counts[stage] = 0
+            samples[self.__counts[stage] % self.window] = seconds
+            self.__counts[stage] += 1
+
+    def summary(self):
+        """Returns {stage: (mean ms, p95 ms)} over each stage's window."""
+        with self.__lock:
+            windows = {stage: samples[:min(self.__counts[stage], self.window)].copy()
+                       for stage, samples in self.__samples.items()}
+        return {stage: (1000 * float(w.mean()), 1000 * float(numpy.percentile(w, 95)))
+                for stage, w in windows.items() if len(w) > 0}
+
+logLevels = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+
+class AsyncLog:
+    """Logging that is cheap enough for the frame loop.
+
+    A call below level returns before anything is formatted. Each message
+    (the format string) may log at most rate times a second; the rest are
+    counted and the count is added to the next one let through. Records
+    go into a bounded in-memory ring (the oldest are dropped if it fills)
+    and a background thread formats them with str.format and writes them
+    to stderr and, once configured, a file that is rolled over at maxBytes.
+    Nothing here waits on I/O, so logging never holds up a frame.
+
+    Arguments are formatted later on another thread, so pass values that
+    will not change, not buffers that are reused.
+    """
+
+    names = {level: name.upper() for name, level in logLevels.items()}
+
+    def __init__(self, level=logLevels["info"], rate=2, capacity=1024, interval=0.2):
+        self.level = level
+        self.rate = rate
+        self.interval = interval
+        self.path = None
+        self.maxBytes = 1000000
+        self.echo = True # write to stderr as well as the file
+        self.suppressed = 0
+        self.overflowed = 0
+        self.__records = collections.deque(maxlen=capacity)
+        self.__limits = {}
+        self.__thread = None
+        self.__file = None
+        self.__writeLock = threading.Lock()
+
+    def configure(self, config):
+        """Apply a "log" config object: "path", "level" and "max bytes", all optional."""
+        self.level = logLevels[config.get("level", "info")]
+        self.maxBytes = int(config.get("max bytes", self.maxBytes))
+        self.path = config.get("path")
+
+    def enabled(self, level):
+        return level >= self.level
+
+    def log(self, level, message, *args):
+        """Queue message.format(*args) at level, unless gated or rate limited."""
+        if level < self.level:
+            return
+        now = time.time()
+        limit = self.__limits.get(message)
+        if limit is None or now - limit[0] >= 1.0:
+            suppressed = limit[2] if limit is not None else 0
+            limit = self.__limits[message] = [now, 0, 0]
+        else:
+            suppressed = 0
+        if limit[1] >= self.rate:
+            limit[2] += 1
+            self.suppressed += 1
+            return
+        limit[1] += 1
+        if len(self.__records) == self.__records.maxlen:
+            self.overflowed += 1
+        self.__records.append((now, level, message, args, suppressed))
+        if self.__thread is None:
+            self.__start()
+
+    def debug(self, message, *args):
+        if self.level <= 10:
+            self.log(10, message, *args)
+
+    def info(self, message, *args):
+        if self.level <= 20:
+            self.log(20, message, *args)
+
+    def warning(self, message, *args):
+        if self.level <= 30:
+            self.log(30, message, *args)
+
+    def error(self, message, *args):
+        if self.level <= 40:
+            self.log(40, message, *args)
+
+    def __start(self):
+        with self.__writeLock:
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__drain, name="log", daemon=True)
+                self.__thread.start()
+
+    def __drain(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        """Format and write everything queued so far."""
+        with self.__writeLock:
+            lines = []
+            while self.__records:
+                when, level, message, args, suppressed = self.__records.popleft()
+                try:
+                    text = message.format(*args)
+                except (IndexError, KeyError, ValueError) as err:
+                    text = "{} {!r} ({})".format(message, args, err)
+                if suppressed:
+                    text += " ({} more suppressed)".format(suppressed)
+                lines.append("{}.{:03d} {} {}\n".format(time.strftime("%H:%M:%S", time.localtime(when)),
+                                                        int(when % 1 * 1000), self.names.get(level, level), text))
+            if not lines:
+                return
+            text = "".join(lines)
+            if self.echo:
+                sys.stderr.write(text)
+                sys.stderr.flush()
+            if self.path is not None:
+                self.__write(text)
+
+    def __write(self, text):
+        try:
+            if self.__file is None:
+                self.__file = open(self.path, "at", encoding="utf-8")
+            if self.__file.tell() + len(text) > self.maxBytes:
+                self.__file.close()
+                os.replace(self.path, self.path + ".1")
+                self.__file = open(self.path, "at", encoding="utf-8")
+            self.__file.write(text)
+            self.__file.flush()
+        except OSError as err:
+            self.path = None
+            self.__file = None
+            sys.stderr.write("log file disabled: {}\n".format(err))
+
+log = AsyncLog()
+
+class TargetEstimator:
+    """Constant-velocity Kalman filter over bearing, elevation and distance.
+
+    update() is given every frame's capture timestamp in seconds and the
+    solved values, or None when the frame had no target. A frame whose
+    values are too far from the prediction is rejected as an outlier; after
+    maxOutliers of them in a row the filter restarts on the new values, as
+    the target probably did move. Without measurements the estimate is
+    carried on its velocity for up to maxCoast seconds.
+    """
+
+    fields = ['bearing', 'elevation', 'distance']
+
+    def __init__(self):
+        # standard deviation of a single frame's value
+        self.measurementNoise = [0.5, 0.01, 0.05]
+        # standard deviation of unmodelled acceleration, per second squared
+        self.acceleration = [30.0, 0.5, 3.0]
+        # innovations beyond this many standard deviations are outliers
+        self.gate = 4.0
+        self.maxOutliers = 3
+        self.maxCoast = 0.5
+        self.outliers = 0
+        self.__states = None
+        self.__time = 0.0
+        self.__lastUpdate = 0.0
+        self.__rejected = 0
+
+    def update(self, timestamp, values):
+        """Add one frame. Returns False if values was rejected as an outlier."""
+        if values is None:
+            if self.__states is not None:
+                self.__predict(timestamp)
+            return True
+        measured = [values[name] for name in self.fields]
+        if self.__states is None or timestamp - self.__lastUpdate > self.maxCoast:
+            self.__start(timestamp, measured)
+            return True
+        self.__predict(timestamp)
+        for z, state, r in zip(measured, self.__states, self.measurementNoise):
+            position, velocity, p00, p01, p11 = state
+            if (z - position) ** 2 > self.gate * self.gate * (p00 + r * r):
+                self.outliers += 1
+                self.__rejected += 1
+                if self.__rejected >= self.maxOutliers:
+                    self.__start(timestamp, measured)
+                return False
+        self.__rejected = 0
+        self.__lastUpdate = timestamp
+        for z, state, r in zip(measured, self.__states, self.measurementNoise):
+            position, velocity, p00, p01, p11 = state
+            s = p00 + r * r
+            k0, k1 = p00 / s, p01 / s
+            innovation = z - position
+            state[:] = [position + k0 * innovation, velocity + k1 * innovation,
+                        (1 - k0) * p00, (1 - k0) * p01, p11 - k1 * p01]
+        return True
+
+    def valid(self, timestamp):
+        """True while the estimate is no more than maxCoast seconds old."""
+        return self.__states is not None and timestamp - self.__lastUpdate <= self.maxCoast
+
+    def estimate(self, timestamp):
+        """The (values, rates) lists extrapolated to timestamp; the filter is not changed."""
+        if self.__states is None:
+            return [0.0] * len(self.fields), [0.0] * len(self.fields)
+        dt = timestamp - self.__time
+        return ([state[0] + state[1] * dt for state in self.__states],
+                [state[1] for state in self.__states])
+
+    def __start(self, timestamp, measured):
+        # unknown velocity: as uncertain as one second of maximum acceleration
+        self.__states = [[z, 0.0, r * r, 0.0, a * a] for z, r, a in zip(measured, self.measurementNoise, self.acceleration)]
+        self.__time = timestamp
+        self.__lastUpdate = timestamp
+        self.__rejected = 0
+
+    def __predict(self, timestamp):
+        dt = max(timestamp - self.__time, 0.0)
+        self.__time = max(timestamp, self.__time)
+        for state, a in zip(self.__states, self.acceleration):
+            position, velocity, p00, p01, p11 = state
+            q = a * a
+            state[:] = [position + velocity * dt, velocity,
+                        p00 + dt * (2 * p01 + dt * p11) + q * dt ** 3 / 3,
+                        p01 + dt * p11 + q * dt ** 2 / 2,
+                        p11 + q * dt]
+
+# layout of the 'target' number array in the 'Target Info' table, one per
+# frame. timestamp is grabFrame's capture time in microseconds, latency is
+# capture to publish in milliseconds, valid is 1 when a target was solved
+# (the solved values are 0 when it is not) and reused is 1 when the frame
+# looked like the last processed one and its values were used again.
+targetPacketFields = ['frame id', 'timestamp', 'latency', 'valid',
+                      'bearing', 'elevation', 'distance', 'left d', 'right d',
+                      'bearing left', 'bearing right', 'elevationLeft', 'elevationRight',
+                      'reused']
+
+def targetPacket(result, latency):
+    """Pack a TargetResult into the 'target' number array."""
+    packet = [float(result.frameId), float(result.timestamp), latency * 1000, 1.0 if result.solved else 0.0]
+    for key in targetPacketFields[4:-1]:
+        packet.append(float(result.values.get(key, 0.0)))
+    packet.append(1.0 if result.reused else 0.0)
+    return packet
+
+# layout of the 'estimate' number array, published next to 'target' for
+# every frame. timestamp is the frame's and 'predicted ...' is the estimate
+# carried forward by the frame's latency, to when it is published
+# ('predicted time', in the same microseconds as timestamp). Rates are per
+# second; valid is 0 once the target has been lost for too long.
+estimatePacketFields = ['timestamp', 'valid'] + TargetEstimator.fields + \
+    [name + ' rate' for name in TargetEstimator.fields] + \
+    ['predicted ' + name for name in TargetEstimator.fields] + ['predicted time']
+
+def estimatePacket(estimator, result, latency):
+    """Update estimator with a TargetResult and pack the 'estimate' number array."""
+    timestamp = result.timestamp / 1e6
+    estimator.update(timestamp, result.values if result.solved else None)
+    values, rates = estimator.estimate(timestamp)
+    predicted, rates = estimator.estimate(timestamp + latency)
+    valid = 1.0 if estimator.valid(timestamp) else 0.0
+    return [float(result.timestamp), valid] + values + rates + predicted + [float(result.timestamp) + latency * 1e6]
+
+# the 'candidates' number array: x, y, w, h and score of each of the
+# pipeline's select_count best contours, best first, in frame pixels.
+# The first one is the target the 'target' array was solved for.
+def candidatesPacket(result):
+    """Flatten a TargetResult's candidates into the 'candidates' number array."""
+    return [float(v) for candidate in result.candidates for v in candidate]
+
+def publishStats(diagnostics, stats, fps):
+    """Publish a StageStats summary to the diagnostics table.
+
+    Each stage is a [mean ms, p95 ms] number array; 'latency' is capture
+    to publish.
+    """
+    for stage, (mean, p95) in stats.summary().items():
+        diagnostics.putNumberArray(stage, [mean, p95])
+    diagnostics.putNumber('fps', fps)
+
+class LiveParameters:
+    """Tuning values that can be changed from the dashboard while running.
+
+    Every value gets an NT entry with a listener, like the switched camera
+    keys. Listeners only queue the change; the processing stage calls
+    applyPending() between frames, so each frame sees one consistent set
+    of values and nothing is looked up in NT per frame.
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.__apply = {}
+        self.__check = {}
+        self.__entries = {}
+        self.__pending = {}
+        self.__lock = threading.Lock()
+
+    def add(self, table, name, default, apply, check=None):
+        """Add a tuning value.
+
+        name is the entry's key in table, default its value unless one was
+        saved in the config file, and apply(value) puts a new value into
+        effect. A value must have default's shape; check(value), if given,
+        returns why a value can't be used, or None if it can. Values that
+        can't be used are logged and the old value is kept.
+        """
+        self.__apply[name] = apply
+        self.__check[name] = check
+        value = savedParameters.get(name, default)
+        problem = self.__problem(name, value, default)
+        if problem is not None:
+            log.warning("ignoring saved {} = {}: {}", name, value, problem)
+            value = default
+        self.values[name] = value
+        if value != default:
+            apply(value)
+
+        entry = table.getEntry(name)
+        self.__entries[name] = entry
+        if isinstance(value, (list, tuple)):
+            entry.setDefaultDoubleArray(value)
+        else:
+            entry.setDefaultDouble(value)
+
+        def listener(fromobj, key, value, isNew):
+            if isinstance(value, tuple):
+                value = list(value)
+            with self.__lock:
+                self.__pending[name] = value
+
+        entry.addListener(
+            listener,
+            ntcore.constants.NT_NOTIFY_IMMEDIATE |
+            ntcore.constants.NT_NOTIFY_NEW |
+            ntcore.constants.NT_NOTIFY_UPDATE)
+
+    def applyPending(self):
+        """Put every queued change into effect; True if any value changed. Cheap when nothing changed."""
+        if not self.__pending:
+            return False
+        with self.__lock:
+            pending = self.__pending
+            self.__pending = {}
+        changed = False
+        for name, value in pending.items():
+            if value == self.values[name]:
+                continue
+            problem = self.__problem(name, value, self.values[name])
+            if problem is None:
+                self.values[name] = value
+                self.__apply[name](value)
+                changed = True
+                continue
+            # NT keeps the value on the server and hands it back on every
+            # boot, so put the old one back rather than just skipping it
+            log.warning("ignoring {} = {}: {}", name, value, problem)
+            if isinstance(self.values[name], (list, tuple)):
+                self.__entries[name].forceSetDoubleArray(self.values[name])
+            else:
+                self.__entries[name].forceSetDouble(self.values[name])
+        return changed
+
+    def __problem(self, name, value, current):
+        """Why value can't replace current for name, or None if it can."""
+        problem = valueProblem(value, current)
+        if problem is None and self.__check[name] is not None:
+            problem = self.__check[name](value)
+        return problem
+
+    def addSaveKey(self, table, key):
+        """Save the current values to the config file whenever key is set true."""
+        entry = table.getEntry(key)
+        entry.setDefaultBoolean(False)
+
+        def listener(fromobj, key, value, isNew):
+            if value:
+                self.save()
+                entry.setBoolean(False)
+
+        entry.addListener(
+            listener,
+            ntcore.constants.NT_NOTIFY_NEW |
+            ntcore.constants.NT_NOTIFY_UPDATE)
+
+    def save(self):
+        """Write the current values to the config file's "vision parameters"."""
+        with self.__lock:
+            values = dict(self.values)
+        try:
+            with open(configFile, "rt", encoding="utf-8") as f:
+                j = json.load(f)
+            j["vision parameters"] = values
+            # write a copy first so a failed write can't corrupt the config
+            with open(configFile + ".tmp", "wt", encoding="utf-8") as f:
+                json.dump(j, f, indent=4)
+            os.replace(configFile + ".tmp", configFile)
+            log.info("saved vision parameters to '{}'", configFile)
+        except (OSError, ValueError) as err:
+            # /boot is read-only unless the dashboard has it writable
+            log.error("could not save vision parameters to '{}': {}", configFile, err)
+
+def addTuningParameters(params, tuning, gp, camera):
+    """Register everything the dashboard can tune with params."""
+    for name in gp.parameter_names:
+        params.add(tuning, name, gp.get_parameter(name),
+                   lambda value, name=name: gp.set_parameter(name, value),
+                   lambda value, name=name: gp.check_parameter(name, value))
+    for name in cameraConstantNames:
+        params.add(tuning, name, globals()[name],
+                   lambda value, name=name: setCameraConstant(name, value),
+                   lambda value, name=name: checkCameraConstant(name, value))
+    if camera is not None:
+        params.add(ntinst.getTable('SmartDashboard'), 'Exposure', 1,
+                   lambda value: camera.setExposureManual(int(value)))
+    params.addSaveKey(tuning, 'save')
+
+def createPipeline(description=None):
+    """The VisionPipeline for a description, by default the configured one."""
+    return VisionPipeline(pipelineDescription if description is None else description)
+
+# target geometry, solved with NumPy for any number of candidates at once:
+# the distance to each top corner from its elevation and the height
+# difference, then the law of cosines on the triangle the two distances
+# make with the target's width (bird's eye view) for the bearing and
+# distance to the target's middle
+solvedFields = ['bearing left', 'bearing right', 'elevationLeft', 'elevationRight', 'left d', 'right d', 'weird num',
+                'bearing', 'elevation', 'distance']
+
+def contourKeypoints(contours):
+    """Returns the leftmost and rightmost point of every contour as two N x 2 arrays."""
+    left = numpy.array([c[c[:, :, 0].argmin()][0] for c in contours]).reshape(-1, 2)
+    right = numpy.array([c[c[:, :, 0].argmax()][0] for c in contours]).reshape(-1, 2)
+    return left, right
+
+def solveAngles(bearingLeft, elevationLeft, bearingRight, elevationRight, height=None, pitch=None, width=None):
+    """Solve the target geometry from the angles to the target's top corners.
+
+    Every argument is a number or an array with one entry per candidate,
+    so candidates seen by cameras with different poses solve in one call.
+    height (of the target's top above the camera), pitch (the camera's
+    angle up, in degrees) and width default to dh, cameraAngle and
+    targetWidth. Where the corners make no triangle with the target's width
+    (the cosine of the left angle is outside [-1, 1]) or the distance comes
+    out as 0, 'solved' is False and bearing, elevation and distance are NaN.
+    Returns:
+        A dict of arrays, one for each of solvedFields and 'solved'.
+    """
+    height = dh if height is None else numpy.asarray(height, dtype=numpy.float64)
+    pitch = cameraAngle if pitch is None else numpy.asarray(pitch, dtype=numpy.float64)
+    width = targetWidth if width is None else numpy.asarray(width, dtype=numpy.float64)
+    bearingLeft = numpy.asarray(bearingLeft, dtype=numpy.float64)
+    bearingRight = numpy.asarray(bearingRight, dtype=numpy.float64)
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        # find distance between each point and the camera
+        leftD = numpy.abs(height / numpy.tan(numpy.radians(pitch + elevationLeft)))
+        rightD = numpy.abs(height / numpy.tan(numpy.radians(pitch + elevationRight)))
+
+        cosLeft = (-rightD*rightD + leftD*leftD + width*width) / (2*width*leftD)
+        solved = numpy.abs(cosLeft) <= 1
+        aLeft = numpy.arccos(numpy.where(solved, cosLeft, 0.0))
+
+        # find length of above triangle's median
+        median = numpy.sqrt(leftD*leftD + width*width - 2*leftD*width*numpy.cos(aLeft))
+        solved &= median != 0
+
+        # the angle between the median line and leftD, law of cosines again
+        # (rounding can take the cosine just past +-1)
+        cosMid = (-width*width + median*median + leftD*leftD) / (2*leftD*median)
+        midAngle = numpy.degrees(numpy.arccos(numpy.clip(cosMid, -1.0, 1.0)))
+
+        # the true bearing and elevation of the true midpoint of the target
+        bearing = bearingLeft + midAngle
+        elevation = numpy.arctan(height / median)
+
+    if not solved.all():
+        bearing = numpy.where(solved, bearing, numpy.nan)
+        elevation = numpy.where(solved, elevation, numpy.nan)
+        median = numpy.where(solved, median, numpy.nan)
+    return {'bearing left': bearingLeft, 'bearing right': bearingRight,
+            'elevationLeft': numpy.asarray(elevationLeft, dtype=numpy.float64),
+            'elevationRight': numpy.asarray(elevationRight, dtype=numpy.float64),
+            'left d': leftD, 'right d': rightD, 'weird num': cosLeft,
+            'bearing': bearing, 'elevation': elevation, 'distance': median,
+            'solved': solved}
+
+def solvePoints(left, right, model=None, height=None, pitch=None, width=None):
+    """solveAngles for N x 2 arrays of left and right top corners in pixels,
+    seen through model (cameraModel by default)."""
+    if model is None:
+        model = cameraModel
+    bearings, elevations = model.angles(numpy.concatenate((numpy.asarray(left).reshape(-1, 2), numpy.asarray(right).reshape(-1, 2))))
+    n = len(bearings) // 2
+    return solveAngles(bearings[:n], elevations[:n], bearings[n:], elevations[n:], height, pitch, width)
+
+def solveContour(x, y, w, h, c, result):
+    """Solve the target geometry for a contour found by the pipeline into result."""
+    result.found = True
+    result.rect = (x, y, w, h)
+
+    # determine the most extreme points along the contour (top left/right points)
+    left, right = contourKeypoints([c])
+    result.extLeft = tuple(left[0])
+    result.extRight = tuple(right[0])
+
+    solution = solvePoints(left, right)
+    values = {field: float(solution[field][0]) for field in solvedFields}
+    result.solved = bool(solution['solved'][0])
+    if not result.solved:
+        log.debug("no solution: cos of the left angle is {:.3f}", values['weird num'])
+        for field in solvedFields[7:]:
+            del values[field]
+    result.values.update(values)
+    return result
+
+def drawTarget(img, result, sx=1.0, sy=1.0):
+    """Draw the target overlay for result onto img, which is the frame
+    scaled by sx horizontally and sy vertically."""
+    x, y, w, h = result.rect
+    x, y, w, h = int(x * sx), int(y * sy), int(w * sx), int(h * sy)
+    extLeft = (int(result.extLeft[0] * sx), int(result.extLeft[1] * sy))
+    extRight = (int(result.extRight[0] * sx), int(result.extRight[1] * sy))
+    cv2.rectangle(img, (x, y), (x+w, h+y), (255, 255, 255), 1)
+
+    # draw the extreme points as circles
+    radius = max(2, int(8 * sx))
+    cv2.circle(img, extLeft, radius, (0, 0, 255), -1)
+    cv2.circle(img, extRight, radius, (0, 0, 255), -1)
+    cv2.line(img, extLeft, extRight, (0, 255, 0), 1)
+
+def processAge():
+    """Seconds since this process was started, so the interpreter start and
+    the imports are counted too."""
+    try:
+        with open("/proc/self/stat", "rt") as f:
+            # field 22, counting from 1, is the start time in clock ticks since boot
+            started = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime", "rt") as f:
+            uptime = float(f.read().split()[0])
+        return uptime - started / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return time.perf_counter() - importTime
+
+importTime = time.perf_counter()
+
+class BootMetrics:
+    """How long the start up took, in seconds since the process started.
+
+    Each event is only recorded the first time it is marked. It is printed
+    to the log and published as 'boot <event>' to the table given to
+    attach(), together with the system uptime at that moment as 'boot
+    <event> uptime', which includes the Pi's own boot.
+    """
+
+    def __init__(self):
+        self.times = {}
+        self.uptimes = {}
+        self.__table = None
+        self.__events = {}
+        self.__lock = threading.Lock()
+
+    def attach(self, table):
+        """Publish the events so far, and every later one, to table."""
+        with self.__lock:
+            self.__table = table
+            for event in self.times:
+                self.__publish(event)
+
+    def mark(self, event):
+        """Record event, unless it was already."""
+        if event in self.times:
+            return
+        with self.__lock:
+            if event in self.times:
+                return
+            self.times[event] = processAge()
+            try:
+                with open("/proc/uptime", "rt") as f:
+                    self.uptimes[event] = float(f.read().split()[0])
+            except OSError:
+                self.uptimes[event] = self.times[event]
+            print("boot: {} after {:.2f} s".format(event, self.times[event]))
+            if self.__table is not None:
+                self.__publish(event)
+            self.__event(event).set()
+
+    def wait(self, event, timeout=None):
+        """Wait until event is marked; returns False on timeout."""
+        with self.__lock:
+            flag = self.__event(event)
+        return flag.wait(timeout)
+
+    def __event(self, event):
+        return self.__events.setdefault(event, threading.Event())
+
+    def __publish(self, event):
+        self.__table.putNumber('boot ' + event, self.times[event])
+        self.__table.putNumber('boot ' + event + ' uptime', self.uptimes[event])
+
+class DebugStream:
+    """The annotated "Rectangle" stream as a stage of its own.
+
+    offer() is called for every processed frame but does nothing unless an
+    MJPEG client is connected and the frame-rate cap allows another frame.
+    outputStream may be None until attach() is called, so the stream can be
+    set up after the vision loop is already running.
+    Then it takes a downscaled copy, and the overlay and JPEG encode happen
+    on the stream's own thread, so the processing frame is never written to.
+    """
+
+    def __init__(self, outputStream, width, height, maxFps, stats):
+        self.width = width
+        self.height = height
+        self.maxFps = maxFps
+        self.__outputStream = outputStream
+        self.__stats = stats
+        # 3 slots: the newest, the one being encoded and one to write
+        self.__frames = FrameRing(3, (height, width, 3))
+        self.__results = [None] * 3
+        self.__last = 0.0
+        threading.Thread(target=runStage, args=(self.__loop,), daemon=True).start()
+
+    def attach(self, outputStream):
+        """Start sending frames to outputStream."""
+        self.__outputStream = outputStream
+
+    def offer(self, img, result):
+        """Queue img (with result's overlay) for the stream, if anyone is watching."""
+        now = time.perf_counter()
+        if now - self.__last < 1.0 / self.maxFps:
+            return
+        # the MJPEG server only enables its source while clients are connected
+        outputStream = self.__outputStream
+        if outputStream is None or not outputStream.isEnabled():
+            return
+        self.__last = now
+        i = self.__frames.acquireWrite()
+        cv2.resize(img, (self.width, self.height), dst=self.__frames.buffers[i], interpolation=cv2.INTER_NEAREST)
+        self.__results[i] = (result, img.shape)
+        self.__frames.commitWrite(i, result.timestamp)
+        self.__stats.record('stream resize', time.perf_counter() - now)
+
+    def __loop(self):
+        lastId = 0
+        while True:
+            i = self.__frames.acquireRead(lastId)
+            lastId = self.__frames.frameIds[i]
+            small = self.__frames.buffers[i]
+            result, shape = self.__results[i]
+            if result.found:
+                start = time.perf_counter()
+                drawTarget(small, result, self.width / shape[1], self.height / shape[0])
+                self.__stats.record('draw', time.perf_counter() - start)
+            start = time.perf_counter()
+            self.__outputStream.putFrame(small)
+            self.__stats.record('putFrame', time.perf_counter() - start)
+            self.__frames.release(i)
+
+# recordings start with a JSON header padded to this many bytes
+recordingHeaderSize = 4096
+
+def recordingDtype(shape, fields):
+    """One frame of a recording: sequence is 0 for a slot never written."""
+    return numpy.dtype([('sequence', '<i8'), ('frame id', '<i8'), ('timestamp', '<f8'),
+                        ('target', '<f8', (len(fields),)), ('image', 'u1', tuple(shape))])
+
+class FrameRecorder:
+    """Records frames from a FrameRing, with their 'target' packets, into a
+    memory-mapped ring file that replays with ReplaySource.
+
+    offer() only takes another hold on the frame's slot; copying it into
+    the file happens on the recorder's own thread. If that thread is still
+    busy with an earlier frame the waiting one is dropped, so recording
+    never slows the vision loop down. The ring needs two extra slots.
+    """
+
+    def __init__(self, path, ring, frames, fields=targetPacketFields):
+        self.path = path
+        self.dropped = 0
+        self.__ring = ring
+        self.__sequence = 0
+        shape = ring.buffers[0].shape
+        header = json.dumps({"shape": list(shape), "frames": frames, "target fields": fields}).encode()
+        if len(header) >= recordingHeaderSize:
+            raise ValueError("recording header too long")
+        dtype = recordingDtype(shape, fields)
+        with open(path, "wb") as f:
+            f.write(header.ljust(recordingHeaderSize, b"\0"))
+            f.truncate(recordingHeaderSize + dtype.itemsize * frames)
+        self.__records = numpy.memmap(path, dtype=dtype, mode="r+", offset=recordingHeaderSize, shape=(frames,))
+        self.__pending = LatestSlot(onDrop=self.__drop)
+        threading.Thread(target=runStage, args=(self.__loop,), daemon=True).start()
+
+    def offer(self, result, packet):
+        """Record the frame in result's slot, which the caller holds, and its packet."""
+        self.__ring.hold(result.slot)
+        self.__pending.put((result.slot, result.frameId, result.timestamp, packet))
+
+    def __drop(self, item):
+        self.dropped += 1
+        self.__ring.release(item[0])
+
+    def __loop(self):
+        while True:
+            slot, frameId, timestamp, packet = self.__pending.get()
+            self.__sequence += 1
+            record = self.__records[self.__sequence % len(self.__records)]
+            # mark the slot as being written, in case we die halfway
+            record['sequence'] = 0
+            frame = self.__ring.buffers[slot]
+            height, width = record['image'].shape[:2]
+            if frame.shape != record['image'].shape:
+                # the camera changed mode since the ring was made
+                frame = cv2.resize(frame, (width, height))
+            record['image'] = frame
+            self.__ring.release(slot)
+            record['frame id'] = frameId
+            record['timestamp'] = timestamp
+            record['target'] = packet
+            record['sequence'] = self.__sequence
+
+class ReplaySource:
+    """Plays a FrameRecorder file back through grabFrame, like a CvSink.
+
+    With realtime the frames come at the pace they were recorded, otherwise
+    as fast as they are asked for. With loop the recording starts over at
+    the end (with timestamps that keep increasing), otherwise grabFrame
+    fails with "end of recording".
+    """
+
+    def __init__(self, path, realtime=True, loop=True):
+        with open(path, "rb") as f:
+            header = json.loads(f.read(recordingHeaderSize).rstrip(b"\0").decode())
+        self.shape = tuple(header["shape"])
+        self.fields = header["target fields"]
+        self.realtime = realtime
+        self.loop = loop
+        records = numpy.memmap(path, dtype=recordingDtype(self.shape, self.fields), mode="r",
+                               offset=recordingHeaderSize, shape=(header["frames"],))
+        written = numpy.flatnonzero(records['sequence'])
+        self.__order = written[numpy.argsort(records['sequence'][written])]
+        self.__records = records
+        self.__next = 0
+        self.__error = ""
+        # a loop takes as long as the recording plus one frame interval
+        timestamps = records['timestamp'][self.__order]
+        self.__span = 0.0
+        if len(timestamps) > 1:
+            self.__span = float(timestamps[-1] - timestamps[0] + numpy.median(numpy.diff(timestamps)))
+        self.__start = None
+
+    def __len__(self):
+        return len(self.__order)
+
+    def record(self, i):
+        """(image, timestamp, {target field: value}) of the i-th recorded frame."""
+        record = self.__records[self.__order[i]]
+        return record['image'], float(record['timestamp']), dict(zip(self.fields, record['target'].tolist()))
+
+    def grabFrame(self, image, timeout=0.225):
+        """Copy the next frame into image. Returns (timestamp, image), or
+        (0, image) at the end of the recording; see getError."""
+        if self.__next >= len(self.__order) and not self.loop or len(self.__order) == 0:
+            self.__error = "end of recording"
+            time.sleep(timeout)
+            return 0, image
+        loops, i = divmod(self.__next, len(self.__order))
+        self.__next += 1
+        record = self.__records[self.__order[i]]
+        timestamp = float(record['timestamp']) + loops * self.__span
+        if self.realtime:
+            now = time.perf_counter()
+            if self.__start is None:
+                self.__start = (now, timestamp)
+            delay = self.__start[0] + (timestamp - self.__start[1]) / 1e6 - now
+            if delay > 0:
+                time.sleep(delay)
+        if image is None or image.shape != self.shape:
+            image = numpy.array(record['image'])
+        else:
+            image[...] = record['image']
+        return timestamp, image
+
+    def getError(self):
+        return self.__error
+
+class CaptureWatchdog:
+    """Health of one camera's capture: counts grabs, grab errors and the
+    frames the camera dropped, measures frame interval jitter, and brings
+    a stalled camera back without restarting the program.
+
+    The capture loop calls grabbed() or failed() after every grab; check()
+    runs a few times a second on the watchdog thread (see watchdogLoop).
+    When no frame has arrived for stallTimeout seconds the camera's
+    settings are applied again, and if that does not help within another
+    stallTimeout it is closed and reopened; the two alternate until frames
+    come back. cscore only flags a new connection strategy and its camera
+    thread acts on it in its own time, so the reopen waits for a later
+    check(), once the camera reports it is disconnected (or another
+    stallTimeout has passed).
+    """
 
-    if len(sys.argv) >= 2:
-        configFile = sys.argv[1]
+    def __init__(self, name, camera=None, config=None, window=64):
+        """camera and config are the UsbCamera and its frc.json object;
+        without them (e.g. a replay) stalls are only counted."""
+        self.name = name
+        self.camera = camera
+        self.config = config
+        fps = config.get("fps") if config is not None else None
+        # expected microseconds between frames, or None to use the median
+        self.interval = 1e6 / fps if fps else None
+        self.stallTimeout = 1.0 # seconds
+        self.startTimeout = 5.0 # seconds to the first frame
+        self.frames = 0
+        self.errors = 0
+        self.dropped = 0
+        self.stalls = 0
+        self.reconnects = 0
+        self.lastError = ""
+        self.__intervals = numpy.zeros(window)
+        self.__count = 0
+        self.__lastTimestamp = 0
+        self.__lastFrame = time.perf_counter()
+        self.__stalled = False
+        self.__attempts = 0
+        self.__lastAttempt = 0.0
+        # when the camera was force closed, until it is reopened
+        self.__closedAt = None
+        self.__lock = threading.Lock()
+
+    def grabbed(self, timestamp):
+        """A frame arrived; timestamp is grabFrame's, in microseconds."""
+        with self.__lock:
+            self.frames += 1
+            self.__lastFrame = time.perf_counter()
+            if self.__lastTimestamp and timestamp > self.__lastTimestamp:
+                interval = timestamp - self.__lastTimestamp
+                self.__intervals[self.__count % len(self.__intervals)] = interval
+                self.__count += 1
+                expected = self.__expected()
+                if expected:
+                    self.dropped += max(0, int(round(interval / expected)) - 1)
+            self.__lastTimestamp = timestamp
+            if self.__stalled:
+                self.__stalled = False
+                self.__attempts = 0
+
+    def failed(self, error):
+        """A grab returned an error instead of a frame."""
+        with self.__lock:
+            self.errors += 1
+            self.lastError = error
+
+    def __expected(self):
+        if self.interval is not None:
+            return self.interval
+        n = min(self.__count, len(self.__intervals))
+        return float(numpy.median(self.__intervals[:n])) if n >= 8 else None
+
+    def healthy(self, now=None):
+        """True while frames keep arriving."""
+        if now is None:
+            now = time.perf_counter()
+        return now - self.__lastFrame < (self.stallTimeout if self.frames else self.startTimeout)
+
+    def check(self, now=None):
+        """Detect a stall and take the next recovery step; returns True if healthy."""
+        if now is None:
+            now = time.perf_counter()
+        if self.__closedAt is not None:
+            self.__reopen(now)
+            return False
+        if self.healthy(now):
+            return True
+        with self.__lock:
+            if not self.__stalled:
+                self.__stalled = True
+                self.stalls += 1
+                log.warning("camera '{}': no frames for {:.1f} s ({})", self.name, now - self.__lastFrame, self.lastError)
+            elif now - self.__lastAttempt < self.stallTimeout:
+                return False
+            attempt = self.__attempts
+            self.__attempts += 1
+            self.__lastAttempt = now
+        if self.camera is not None:
+            try:
+                if attempt % 2 == 0:
+                    log.warning("camera '{}': applying its settings again", self.name)
+                    self.camera.setConfigJson(json.dumps(self.config))
+                else:
+                    log.warning("camera '{}': reconnecting", self.name)
+                    self.camera.setConnectionStrategy(VideoSource.ConnectionStrategy.kForceClose)
+                    self.__closedAt = now
+            except Exception:
+                traceback.print_exc()
+        return False
+
+    def __reopen(self, now):
+        """Reopen the force closed camera once it has closed."""
+        try:
+            if self.camera.isConnected() and now - self.__closedAt < self.stallTimeout:
+                return
+            self.camera.setConnectionStrategy(VideoSource.ConnectionStrategy.kKeepOpen)
+            self.reconnects += 1
+        except Exception:
+            traceback.print_exc()
+        self.__closedAt = None
+        with self.__lock:
+            # give the reopened camera a whole stallTimeout before the next step
+            self.__lastAttempt = now
+
+    def publish(self, table, now=None):
+        """Put the health and throughput counters in table."""
+        if now is None:
+            now = time.perf_counter()
+        with self.__lock:
+            n = min(self.__count, len(self.__intervals))
+            intervals = self.__intervals[:n].copy()
+            expected = self.__expected()
+        table.putBoolean('healthy', self.healthy(now))
+        table.putNumber('frames', self.frames)
+        table.putNumber('errors', self.errors)
+        table.putNumber('dropped', self.dropped)
+        table.putNumber('stalls', self.stalls)
+        table.putNumber('reconnects', self.reconnects)
+        table.putString('last error', self.lastError)
+        if n > 0:
+            table.putNumber('fps', 1e6 / float(intervals.mean()))
+            # p95 distance from the expected frame interval, in ms
+            if expected:
+                table.putNumber('jitter', float(numpy.percentile(numpy.abs(intervals - expected), 95)) / 1000)
+
+def watchdogLoop(watchdogs, table, interval=0.25):
+    """Check every CaptureWatchdog and publish them under table/<camera name>.
+
+    On its own thread, as the other stages wait for frames and stop when
+    the camera does. watchdogs may grow while this runs.
+    """
+    while True:
+        now = time.perf_counter()
+        for watchdog in list(watchdogs):
+            watchdog.check(now)
+            watchdog.publish(table.getSubTable(watchdog.name), now)
+        time.sleep(interval)
+
+def runStage(target, *args):
+    """Run a pipeline stage; if it dies, take the whole process down with it
+    (as the single-threaded loop did) so it gets restarted, rather than
+    leaving the other stages waiting forever."""
+    try:
+        target(*args)
+    except BaseException:
+        log.flush()
+        traceback.print_exc()
+        sys.stderr.flush()
+        os._exit(1)
+
+def captureLoop(cvSink, ring, stats, watchdog=None):
+    """Capture stage: grab frames into the ring as fast as the camera delivers them."""
+    while True:
+        i = ring.acquireWrite()
+        start = time.perf_counter()
+        t, frame = cvSink.grabFrame(ring.buffers[i])
+        stats.record('grab', time.perf_counter() - start)
+        if t == 0:
+            error = cvSink.getError()
+            if watchdog is not None:
+                watchdog.failed(error)
+            log.warning("grab error: {}", error)
+            ring.abortWrite(i)
+            continue
+        if watchdog is not None:
+            watchdog.grabbed(t)
+        ring.commitWrite(i, t, frame)
+
+def processLoop(ring, gp, results, stats, params, gate):
+    """Processing stage: always work on the newest captured frame."""
+    lastId = 0
+    last = None
+    while True:
+        i = ring.acquireRead(lastId)
+        if params.applyPending():
+            # a result from before the change is no answer for this frame
+            gate.reset()
+        lastId = ring.frameIds[i]
+        result = TargetResult(i, lastId, ring.timestamps[i], ring.captureTimes[i])
+        start = time.perf_counter()
+        unchanged = gate.unchanged(ring.buffers[i]) and last is not None
+        stats.record('gate', time.perf_counter() - start)
+        if unchanged:
+            result.reuse(last)
+        else:
+            x,y,w,h,c = gp.process(ring.buffers[i])
+            result.candidates = gp.targets
+            if x != -1:
+                start = time.perf_counter()
+                solveContour(x, y, w, h, c, result)
+                stats.record('geometry', time.perf_counter() - start)
+            last = result
+        # the slot stays held until the publish stage is done with it
+        results.put(result)
+
+def publishLoop(ring, results, table, stream, stats, diagnostics, estimator, recorder=None, boot=None):
+    """Publish stage: NetworkTables values, then hand the frame to the debug stream."""
+    statsInterval = 0.25 # seconds between diagnostics updates
+    lastStats = time.perf_counter()
+    frames = 0
+    reused = 0
+    while True:
+        result = results.get()
+
+        # one entry per frame, so the robot never mixes values from two
+        # frames; flush sends it now instead of at the next NT update
+        latency = time.perf_counter() - result.captureTime
+        packet = targetPacket(result, latency)
+        table.putNumberArray('target', packet)
+        table.putNumberArray('estimate', estimatePacket(estimator, result, latency))
+        table.putNumberArray('candidates', candidatesPacket(result))
+        ntinst.flush()
+
+        if boot is not None:
+            boot.mark('first frame')
+            if result.solved:
+                boot.mark('first target')
+
+        if recorder is not None:
+            recorder.offer(result, packet)
+        stream.offer(ring.buffers[result.slot], result)
+        ring.release(result.slot)
+        now = time.perf_counter()
+        stats.record('latency', now - result.captureTime)
+
+        frames += 1
+        if result.reused:
+            reused += 1
+        if now - lastStats >= statsInterval:
+            publishStats(diagnostics, stats, frames / (now - lastStats))
+            diagnostics.putNumber('reused', reused / frames)
+            diagnostics.putNumber('outliers', estimator.outliers)
+            if recorder is not None:
+                diagnostics.putNumber('recording dropped', recorder.dropped)
+            diagnostics.putNumber('log dropped', log.suppressed + log.overflowed)
+            lastStats = now
+            frames = 0
+            reused = 0
+
+class SharedFrameSlots:
+    """Newest-frame handoff from a capture thread to a worker process.
+
+    Frames live in shared memory (multiprocessing.RawArray, which works on
+    the Pi's Python 3.7), so nothing is pickled. Like FrameRing, the
+    capture side always writes a slot the worker is not reading and the
+    worker only ever takes the newest frame.
+    """
+
+    def __init__(self, context, shape, size=3):
+        self.shape = shape
+        self.__arrays = [context.RawArray('B', int(numpy.prod(shape))) for i in range(size)]
+        self.__frameIds = context.RawArray('q', size)
+        self.__timestamps = context.RawArray('d', size)
+        self.__captureTimes = context.RawArray('d', size)
+        # [newest slot, slot the worker holds], -1 for none
+        self.__state = context.RawArray('i', [-1, -1])
+        self.__lock = context.Lock()
+        self.__ready = context.Event()
+        self.__nextId = 1
+        self.__buffers = None
+
+    def __getstate__(self):
+        # the numpy views are rebuilt on the other side
+        state = self.__dict__.copy()
+        state['_SharedFrameSlots__buffers'] = None
+        return state
+
+    def buffer(self, i):
+        """The frame in slot i as a numpy array over the shared memory."""
+        if self.__buffers is None:
+            self.__buffers = [numpy.frombuffer(a, dtype=numpy.uint8).reshape(self.shape) for a in self.__arrays]
+        return self.__buffers[i]
+
+    def acquireWrite(self):
+        """Capture side: pick a slot that is neither the newest nor being read."""
+        with self.__lock:
+            latest, held = self.__state[0], self.__state[1]
+        for i in range(len(self.__arrays)):
+            if i != latest and i != held:
+                return i
+
+    def commitWrite(self, i, timestamp):
+        """Capture side: make slot i the newest frame."""
+        with self.__lock:
+            self.__frameIds[i] = self.__nextId
+            self.__timestamps[i] = timestamp
+            self.__captureTimes[i] = time.perf_counter()
+            self.__state[0] = i
+        self.__nextId += 1
+        self.__ready.set()
+
+    def acquireRead(self, lastId, timeout=None):
+        """Worker side: hold the newest frame if it is newer than lastId.
+
+        Returns (slot, frame id, timestamp, capture time), or None on timeout.
+        """
+        self.__ready.wait(timeout)
+        with self.__lock:
+            self.__ready.clear()
+            i = self.__state[0]
+            if i == -1 or self.__frameIds[i] <= lastId:
+                return None
+            self.__state[1] = i
+            return i, self.__frameIds[i], self.__timestamps[i], self.__captureTimes[i]
+
+    def release(self):
+        """Worker side: done with the held slot."""
+        with self.__lock:
+            self.__state[1] = -1
+
+def sharedCaptureLoop(cvSink, slots, watchdog=None):
+    """Capture stage for a camera handled by a VisionWorker."""
+    height, width = slots.shape[:2]
+    while True:
+        i = slots.acquireWrite()
+        buffer = slots.buffer(i)
+        t, frame = cvSink.grabFrame(buffer)
+        if t == 0:
+            error = cvSink.getError()
+            if watchdog is not None:
+                watchdog.failed(error)
+            log.warning("grab error: {}", error)
+            continue
+        if watchdog is not None:
+            watchdog.grabbed(t)
+        if frame is not buffer:
+            # the camera is not in the mode the slots were sized for
+            cv2.resize(frame, (width, height), dst=buffer)
+        slots.commitWrite(i, t)
+
+def applyParameters(gp, values):
+    """Set gp's parameters and the camera constants that are in values; True if any changed."""
+    changed = False
+    for name in gp.parameter_names:
+        if name not in values or values[name] == gp.get_parameter(name):
+            continue
+        problem = gp.check_parameter(name, values[name])
+        if problem is None:
+            gp.set_parameter(name, values[name])
+            changed = True
+        else:
+            log.warning("ignoring {} = {}: {}", name, values[name], problem)
+    for name in cameraConstantNames:
+        if name not in values or values[name] == globals()[name]:
+            continue
+        problem = checkCameraConstant(name, values[name])
+        if problem is None:
+            setCameraConstant(name, values[name])
+            changed = True
+        else:
+            log.warning("ignoring {} = {}: {}", name, values[name], problem)
+    return changed
+
+def visionWorkerLoop(name, slots, results, updates, values, calibration, description):
+    """Worker process: run a pipeline on every newest frame from slots.
+
+    values are the tuning values to start with; later changes to them
+    arrive on updates.
+    """
+    global cameraModel
+    cameraModel = loadCameraModel(calibration, slots.shape[1], slots.shape[0])
+    gp = createPipeline(description)
+    applyParameters(gp, values)
+    gate = ChangeGate()
+    lastId = 0
+    last = None
+    while True:
+        frame = slots.acquireRead(lastId, 1.0)
+        if frame is None:
+            continue
+        try:
+            if applyParameters(gp, updates.get_nowait()):
+                gate.reset()
+        except queue.Empty:
+            pass
+        i, lastId, timestamp, captureTime = frame
+        result = TargetResult(i, lastId, timestamp, captureTime)
+        if gate.unchanged(slots.buffer(i)) and last is not None:
+            slots.release()
+            result.reuse(last)
+        else:
+            x,y,w,h,c = gp.process(slots.buffer(i))
+            slots.release()
+            result.candidates = gp.targets
+            if x != -1:
+                solveContour(x, y, w, h, c, result)
+            last = result
+        results.put((name, result.frameId, result.timestamp, result.captureTime, result.solved, result.values, result.candidates, result.reused))
+
+def runVisionWorker(name, slots, results, updates, values, calibration, description):
+    runStage(visionWorkerLoop, name, slots, results, updates, values, calibration, description)
+
+class VisionWorker:
+    """A camera after the first: its own sink, capture thread and a
+    pipeline in a separate process, so it uses another core and a stall
+    in one camera never holds up the others."""
+
+    def __init__(self, context, name, cvSink, shape, results, calibration=None, watchdog=None):
+        self.name = name
+        self.__calibration = calibration
+        self.__context = context
+        self.__results = results
+        self.__slots = SharedFrameSlots(context, shape)
+        self.__updates = context.Queue()
+        self.__values = None
+        self.__process = None
+        threading.Thread(target=runStage, args=(sharedCaptureLoop, cvSink, self.__slots, watchdog), daemon=True).start()
+
+    def start(self, values=None):
+        """Start the worker process, or restart it if it died, with the tuning
+        values given (by default the saved ones)."""
+        if self.__process is not None:
+            if self.__process.is_alive():
+                return
+            log.error("vision worker for '{}' exited with {}, restarting", self.name, self.__process.exitcode)
+            self.__slots.release()
+            # whatever was still queued is in values
+            self.__updates = self.__context.Queue()
+        self.__values = dict(savedParameters if values is None else values)
+        self.__process = self.__context.Process(
+            target=runVisionWorker,
+            args=(self.name, self.__slots, self.__results, self.__updates, self.__values, self.__calibration, pipelineDescription),
+            daemon=True)
+        self.__process.start()
+
+    def update(self, values):
+        """Send the worker the tuning values, if they changed since the last ones."""
+        if values != self.__values:
+            self.__values = dict(values)
+            self.__updates.put(self.__values)
+
+def workerPublishLoop(results, workers, params):
+    """Publish what the VisionWorkers find, under 'Target Info/<camera name>',
+    and pass the workers the tuning values in params."""
+    lastCheck = time.perf_counter()
+    estimators = {worker.name: TargetEstimator() for worker in workers}
+    while True:
+        try:
+            name, frameId, timestamp, captureTime, solved, values, candidates, reused = results.get(timeout=1.0)
+            result = TargetResult(-1, frameId, timestamp, captureTime)
+            result.found = result.solved = solved
+            result.values = values
+            result.candidates = candidates
+            result.reused = reused
+            table = ntinst.getTable('Target Info').getSubTable(name)
+            latency = time.perf_counter() - captureTime
+            table.putNumberArray('target', targetPacket(result, latency))
+            table.putNumberArray('estimate', estimatePacket(estimators[name], result, latency))
+            table.putNumberArray('candidates', candidatesPacket(result))
+            ntinst.flush()
+        except queue.Empty:
+            pass
+        now = time.perf_counter()
+        if now - lastCheck >= 1.0:
+            values = dict(params.values)
+            for worker in workers:
+                worker.start(values)
+                worker.update(values)
+            lastCheck = now
+
+def startVision(cvSink, boot, camera=None, sourceName='camera', switched=True, shape=None):
+    """Start the vision loop on cvSink, camera's sink or a stand-in for it,
+    and everything around it: dashboard tuning, recording, capture health
+    and the debug stream, then, once boot has its first frame, the
+    switched cameras (unless switched is False) and the other cameras'
+    workers. sourceName names the capture health entry when there is no
+    camera, and shape is the frames' shape if it is not the configured
+    resolution.
+
+    Returns (stats, publish): the loop's StageStats and the publish stage,
+    for the caller to run on a thread of its choosing.
+    """
+    if shape is None:
+        shape = (resolutionY, resolutionX, 3)
+    inst = CameraServer.getInstance()
+    gp = createPipeline()
+    stats = StageStats()
+    gp.stats = stats
+    diagnostics = ntinst.getTable('Vision Diagnostics')
+
+    table = ntinst.getTable('Target Info')
+    table.putStringArray('target fields', targetPacketFields)
+    table.putStringArray('estimate fields', estimatePacketFields)
+
+    # dashboard tuning, applied between frames by the processing stage
+    params = LiveParameters()
+    addTuningParameters(params, ntinst.getTable('Vision Tuning'), gp, camera)
+
+    # capture -> process -> publish, each stage on its own thread so the
+    # loop runs at the speed of the slowest stage instead of their sum.
+    # 5 slots: one being written, one latest, one each held by the
+    # processor, the handoff and the publisher; a recorder holds two more.
+    ring = FrameRing(5 if recordingConfig is None else 7, shape)
+    results = LatestSlot(onDrop=lambda r: ring.release(r.slot))
+    recorder = None
+    if recordingConfig is not None:
+        recorder = FrameRecorder(recordingConfig["path"], ring, int(recordingConfig.get("frames", 150)))
+    stream = DebugStream(None, streamWidth, streamHeight, streamMaxFps, stats)
+    params.add(ntinst.getTable('Vision Tuning'), 'stream fps', streamMaxFps,
+               lambda value: setattr(stream, 'maxFps', max(value, 0.1)))
+    gate = ChangeGate()
+    params.add(ntinst.getTable('Vision Tuning'), 'gate threshold', gate.threshold,
+               lambda value: setattr(gate, 'threshold', value))
+    params.add(ntinst.getTable('Vision Tuning'), 'gate max reuse', gate.maxReuse,
+               lambda value: setattr(gate, 'maxReuse', int(value)))
+
+    # capture health, under 'Vision Diagnostics/capture/<camera name>'
+    if camera is not None:
+        watchdogs = [CaptureWatchdog(cameraConfigs[0].name, camera, cameraConfigs[0].config)]
+    else:
+        watchdogs = [CaptureWatchdog(sourceName)]
+    threading.Thread(target=runStage, args=(watchdogLoop, watchdogs, diagnostics.getSubTable('capture')), daemon=True).start()
+
+    threading.Thread(target=runStage, args=(captureLoop, cvSink, ring, stats, watchdogs[0]), daemon=True).start()
+    threading.Thread(target=runStage, args=(processLoop, ring, gp, results, stats, params, gate), daemon=True).start()
+
+    def startDeferred():
+        """What the first target does not need: started once the vision
+        loop has published a frame, or after 5 s if it has not."""
+        boot.wait('first frame', 5.0)
+
+        # start switched cameras
+        if switched:
+            for config in switchedCameraConfigs:
+                startSwitchedCamera(config)
+
+        stream.attach(inst.putVideo("Rectangle", streamWidth, streamHeight))
+
+        # every other camera gets a worker process of its own
+        if len(cameras) > 1:
+            context = multiprocessing.get_context('forkserver')
+            workerResults = context.Queue()
+            workers = []
+            for config, other in zip(cameraConfigs[1:], cameras[1:]):
+                shape = (int(config.config.get("height", resolutionY)), int(config.config.get("width", resolutionX)), 3)
+                watchdog = CaptureWatchdog(config.name, other, config.config)
+                watchdogs.append(watchdog)
+                worker = VisionWorker(context, config.name, inst.getVideo(camera=other), shape, workerResults, config.calibration, watchdog)
+                worker.start(params.values)
+                workers.append(worker)
+            threading.Thread(target=runStage, args=(workerPublishLoop, workerResults, workers, params), daemon=True).start()
+        boot.mark('deferred')
+
+    threading.Thread(target=runStage, args=(startDeferred,), daemon=True).start()
+
+    return stats, lambda: publishLoop(ring, results, table, stream, stats, diagnostics, TargetEstimator(), recorder, boot)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="FRC vision")
+    parser.add_argument("config", nargs="?", default=configFile, help="the frc.json to use")
+    parser.add_argument("--replay", help="run on a recording instead of the cameras")
+    parser.add_argument("--fast", action="store_true", help="replay as fast as possible, not at the recorded pace")
+    args = parser.parse_args()
+    configFile = args.config
+
+    boot = BootMetrics()
+    boot.mark('imports')
 
     # read configuration
     if not readConfig():
         sys.exit(1)
+    if logConfig is not None:
+        log.configure(logConfig)
 
-    # start NetworkTables
+    # start NetworkTables; this only starts its thread, connecting happens
+    # in the background while the cameras open
     ntinst = NetworkTablesInstance.getDefault()
     if server:
         print("Setting up NetworkTables server")
@@ -533,105 +2733,30 @@ if __name__ == "__main__":
     else:
         print("Setting up NetworkTables client for team {}".format(team))
         ntinst.startClientTeam(team)
+    diagnostics = ntinst.getTable('Vision Diagnostics')
+    boot.attach(diagnostics)
 
-    camera = 0
-    # start cameras
-    for config in cameraConfigs:
-        camera = startCamera(config)
-        cameras.append(camera)
+    # start cameras, unless a recording stands in for them. Opening a
+    # camera and applying its settings is slow, so they all open at once.
+    if not args.replay and cameraConfigs:
+        with concurrent.futures.ThreadPoolExecutor(len(cameraConfigs)) as pool:
+            cameras.extend(pool.map(startCamera, cameraConfigs))
+        boot.mark('cameras')
+    camera = cameras[0] if cameras else None
 
-    # start switched cameras
-    for config in switchedCameraConfigs:
-        startSwitchedCamera(config)
+    if cameraConfigs:
+        cameraModel = loadCameraModel(cameraConfigs[0].calibration, resolutionX, resolutionY)
 
     print("trying to set up pipeline")
-    inst = CameraServer.getInstance()
-    gp = GripPipeline2()
-    cvSink = inst.getVideo()
-    img = numpy.zeros(shape=(resolutionX, resolutionY, 3), dtype=numpy.uint8)
-    outputStream = inst.putVideo("Rectangle", resolutionX, resolutionY)
-	
-    table = ntinst.getTable('Target Info')
-    ntinst.getTable('SmartDashboard').putNumber('Exposure', 1)
-    lastExposure = 1
-	
+    if args.replay:
+        print("Replaying '{}'".format(args.replay))
+        cvSink = ReplaySource(args.replay, realtime=not args.fast)
+    else:
+        # by camera, as the first to start is not always cameraConfigs[0]
+        cvSink = CameraServer.getInstance().getVideo(camera=camera)
+    stats, publish = startVision(cvSink, boot, camera, 'replay' if args.replay else 'camera', switched=not args.replay)
+
     print("hi")
-	
-    # loop forever
-    while True:
-        _, img = cvSink.grabFrame(img)
-        x,y,w,h,c = gp.process(img)
-        
-        exp = ntinst.getTable('SmartDashboard').getNumber('Exposure',1)
-        if(exp != lastExposure):
-            lastExposure = exp
-            #VideoCamera.setExposureManual(camera,exp)
-            camera.setExposureManual(int(exp))
-        
-        if x != -1:
-            cv2.rectangle(img, (x, y), (x+w, h+y), (255, 255, 255), 1)
-            
-            # determine the most extreme points along the contour (top left/right points)
-            extLeft = tuple(c[c[:, :, 0].argmin()][0])
-            extRight = tuple(c[c[:, :, 0].argmax()][0])
-			
-			# draw the extreme points as circles
-            cv2.circle(img, extLeft, 8, (0, 0, 255), -1)
-            cv2.circle(img, extRight, 8, (0, 0, 255), -1)
-            cv2.line(img, extLeft, extRight, (0, 255, 0), 1)
-			
-            # normalize top left and right points
-            nLeft = normalize(resolutionX, resolutionY,[extLeft[0], extLeft[1]])
-            nRight = normalize(resolutionX, resolutionY,[extRight[0], extRight[1]])
-
-            # find bearing and elevation angles for each point
-            bearingLeft = nLeft[0] * hfov
-            bearingRight = nRight[0] * hfov
-            elevationLeft = nLeft[1] * vfov
-            elevationRight = nRight[1] * vfov
-            
-            # find distance between each point and the camera
-            leftD = abs(dh / (math.tan(math.radians(cameraAngle + elevationLeft))))
-            rightD = abs(dh / (math.tan(math.radians(cameraAngle + elevationRight))))
-
-            aLeft = 0
-            # we can imagine a triangle with leftD, rightD, and targetWidth as its sides (bird's view)
-            # we use law of cosines to solve for the angles of this triangle
-            aCamera = abs(bearingLeft-bearingRight)
-            table.putNumber('weird num', (-rightD*rightD + leftD*leftD + targetWidth*targetWidth)/(2*targetWidth*leftD))
-            if(abs(-rightD*rightD + leftD*leftD + targetWidth*targetWidth)/(2*targetWidth*leftD) <=1):
-                aLeft = math.acos((-rightD*rightD + leftD*leftD + targetWidth*targetWidth)/(2*targetWidth*leftD)) #radians
-            else:
-                print('reeee')
-                print((-rightD*rightD + leftD*leftD + targetWidth*targetWidth)/(2*targetWidth*leftD))
-                
-            
-            # find length of above triangle's median
-            median = math.sqrt(leftD*leftD + targetWidth*targetWidth - 2*leftD*targetWidth*math.cos(aLeft))
-            
-            # from that, find the angle of the angle between the median line and leftD with law of consines 
-            midAngle = 360/(2*math.pi)* math.acos((-targetWidth*targetWidth+median*median+leftD*leftD)/(2*leftD*median))
-            
-            # find the true bearing and elevation of the true midpoint of the target
-            bearing = bearingLeft + midAngle
-            elevation = math.atan(dh/median)
-			
-			# draw top midpoint (not correct)
-            #cv2.circle(img,(int((extLeft[0]+extRight[0])/2), int((extRight[1]+extLeft[1])/2)), 8, (0, 255, 0), -1)
-
-			# get top midpoint normalized
-            #topMidpoint = normalize(resolutionX, resolutionY,[(extLeft[0]+extRight[0])/2, (extRight[1]+extLeft[1])/2])
-			
-            table.putNumber('bearing left', bearingLeft)
-            table.putNumber('bearing right', bearingRight)
-            table.putNumber('elevationLeft', elevationLeft)
-            table.putNumber('elevationRight', elevationRight)
-            table.putNumber('bearing', bearing)
-            table.putNumber('elevation', elevation)
-            table.putNumber('distance', median)
-            table.putNumber('left d', leftD)
-            table.putNumber('right d', rightD)
-
-
-  			
-        outputStream.putFrame(img)
+
+    # the main thread is the publish/stream stage
+    publish()
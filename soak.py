@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+#----------------------------------------------------------------------------
+# Soak test for the vision loop and its NetworkTables publishing.
+#
+# Runs the capture, processing and publish stages of multiCameraServer
+# against a local NetworkTables server (started the way "ntmode": "server"
+# starts it) for a long time. The frames come from a moving copy of an
+# image or from a FrameRecorder recording. A simulated robot and a few
+# simulated dashboards connect as clients over loopback, and every
+# interval it prints:
+#   - the capture-to-client latency each client sees,
+#   - the publish rate,
+#   - CPU use and memory.
+# At the end it fails if memory kept growing or latency kept drifting.
+# Needs pynetworktables (pip3 install pynetworktables); cscore is not needed.
+#
+#   python3 soak.py                                # 10 minutes, example_grip_input.jpg
+#   python3 soak.py vision.rec --duration 3600     # an hour of a recording
+#   python3 soak.py --dashboards 4 --fps 90
+#----------------------------------------------------------------------------
+
+import argparse
+import collections
+import json
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+import cv2
+import numpy
+
+from benchmark import installStubs
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+class SyntheticSource:
+    """A camera stand-in: a still image with the picture sliding side to
+    side, so the target moves and no frame is skipped as unchanged.
+    grabFrame paces the frames at fps and timestamps them in microseconds."""
+
+    def __init__(self, image, fps):
+        self.image = image
+        self.interval = 1.0 / fps
+        self.__next = time.perf_counter()
+        self.__count = 0
+
+    def grabFrame(self, image, timeout=0.225):
+        delay = self.__next - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        self.__next = max(self.__next + self.interval, time.perf_counter() - self.interval)
+        self.__count += 1
+        shift = int(40 * numpy.sin(self.__count / 30.0))
+        if image is None or image.shape != self.image.shape:
+            image = numpy.empty_like(self.image)
+        image[:, max(shift, 0):image.shape[1] + min(shift, 0)] = self.image[:, max(-shift, 0):image.shape[1] - max(shift, 0)]
+        return time.perf_counter() * 1e6, image
+
+    def getError(self):
+        return ""
+
+class TimedSource:
+    """Wraps a frame source to remember when each frame was grabbed, by its
+    timestamp, so a client can work out how old a 'target' packet is."""
+
+    def __init__(self, source, keep=1024):
+        self.source = source
+        self.grabbed = collections.OrderedDict()
+        self.keep = keep
+        self.__lock = threading.Lock()
+
+    def grabFrame(self, image, timeout=0.225):
+        t, frame = self.source.grabFrame(image, timeout)
+        if t != 0:
+            with self.__lock:
+                self.grabbed[float(t)] = time.perf_counter()
+                while len(self.grabbed) > self.keep:
+                    self.grabbed.popitem(last=False)
+        return t, frame
+
+    def grabTime(self, timestamp):
+        with self.__lock:
+            return self.grabbed.get(timestamp)
+
+    def getError(self):
+        return self.source.getError()
+
+class Subscriber:
+    """A NetworkTables client on its own instance, like the robot or a
+    dashboard, that times every 'Target Info/target' update it receives."""
+
+    def __init__(self, name, port, source, tables, timestampField):
+        from networktables import NetworkTablesInstance
+        self.name = name
+        self.source = source
+        self.timestampField = timestampField
+        self.latencies = []
+        self.missing = 0
+        self.__lock = threading.Lock()
+        self.instance = NetworkTablesInstance.create()
+        self.instance.startClient(("127.0.0.1", port))
+        for table in tables:
+            self.instance.getTable(table).addEntryListener(self.__listener, immediateNotify=False)
+
+    def __listener(self, table, key, value, isNew):
+        now = time.perf_counter()
+        if key != 'target':
+            return
+        with self.__lock:
+            grabbed = self.source.grabTime(float(value[self.timestampField]))
+            if grabbed is None:
+                self.missing += 1
+            else:
+                self.latencies.append(now - grabbed)
+
+    def take(self):
+        """Returns the latencies, in seconds, of the 'target' updates since the last take."""
+        with self.__lock:
+            taken = self.latencies
+            self.latencies = []
+        return taken
+
+class LatencyHistogram:
+    """Latencies of a whole run in 0.1 ms bins up to 2 s, so keeping them
+    does not grow the memory the soak test is watching."""
+
+    binWidth = 0.0001 # seconds
+
+    def __init__(self, bins=20000):
+        self.counts = numpy.zeros(bins, dtype=numpy.int64)
+        self.worst = 0.0
+
+    def add(self, latencies):
+        if latencies:
+            bins = numpy.minimum((numpy.array(latencies) / self.binWidth).astype(numpy.intp), len(self.counts) - 1)
+            numpy.add.at(self.counts, bins, 1)
+            self.worst = max(self.worst, max(latencies))
+
+    def percentile(self, p):
+        """The p-th percentile in ms, to the bin's upper edge."""
+        total = self.counts.sum()
+        if total == 0:
+            return 0.0
+        i = int(numpy.searchsorted(numpy.cumsum(self.counts), total * p / 100.0))
+        return (i + 1) * self.binWidth * 1000
+
+def residentBytes():
+    """This process's resident memory; ru_maxrss (the peak) where /proc is missing."""
+    try:
+        with open("/proc/self/statm", "rt") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+def percentiles(samples):
+    if not samples:
+        return [0.0, 0.0, 0.0]
+    return [float(v) * 1000 for v in numpy.percentile(samples, [50, 95, 100])]
+
+def slope(times, values):
+    """Least-squares change of values per hour."""
+    if len(times) < 3:
+        return 0.0
+    return float(numpy.polyfit(numpy.array(times) / 3600.0, values, 1)[0])
+
+def startVision(mcs, source, port, stateDir):
+    """Read a server-mode config, start the NT server and start the vision
+    loop through the main program's startVision, with source as the camera."""
+    config = os.path.join(stateDir, "frc.json")
+    with open(config, "wt", encoding="utf-8") as f:
+        json.dump({"team": mcs.team, "ntmode": "server", "cameras": []}, f)
+    mcs.configFile = config
+    if not mcs.readConfig() or not mcs.server:
+        sys.exit("could not read the soak test config")
+    mcs.ntinst = mcs.NetworkTablesInstance.getDefault()
+    mcs.ntinst.startServer(persistFilename=os.path.join(stateDir, "networktables.ini"), port=port)
+
+    boot = mcs.BootMetrics()
+    boot.attach(mcs.ntinst.getTable('Vision Diagnostics'))
+    frame = source.grabFrame(None)[1]
+    stats, publish = mcs.startVision(source, boot, sourceName='soak', shape=frame.shape)
+    # the main program runs the publish stage on its main thread, which
+    # here reads the clients
+    threading.Thread(target=mcs.runStage, args=(publish,), daemon=True).start()
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description="Vision loop and NetworkTables soak test")
+    parser.add_argument("source", nargs="?", default=os.path.join(here, "example_grip_input.jpg"),
+                        help="an image to move around, or a .rec recording to loop")
+    parser.add_argument("--duration", type=float, default=600, help="seconds to run")
+    parser.add_argument("--interval", type=float, default=10, help="seconds between report lines")
+    parser.add_argument("--fps", type=float, default=30, help="frame rate of an image source")
+    parser.add_argument("--dashboards", type=int, default=2, help="dashboard clients besides the robot")
+    parser.add_argument("--port", type=int, default=1735, help="NetworkTables server port")
+    parser.add_argument("--warmup", type=float, default=0.2, help="fraction of the run left out of the trends")
+    parser.add_argument("--max-growth", type=float, default=20, help="fail above this memory growth, MiB per hour")
+    parser.add_argument("--max-drift", type=float, default=5, help="fail above this p50 latency drift, ms per hour")
+    args = parser.parse_args()
+
+    try:
+        import networktables
+        import ntcore
+    except ImportError:
+        sys.exit("soak.py needs pynetworktables: pip3 install pynetworktables")
+    installStubs()
+    sys.path.insert(0, here)
+    import multiCameraServer as mcs
+
+    if args.source.lower().endswith(".rec"):
+        source = TimedSource(mcs.ReplaySource(args.source))
+    else:
+        image = cv2.imread(args.source)
+        if image is None:
+            sys.exit("could not read '{}'".format(args.source))
+        source = TimedSource(SyntheticSource(image, args.fps))
+
+    stats = startVision(mcs, source, args.port, tempfile.mkdtemp(prefix="soak"))
+    # the robot reads the targets; dashboards show the diagnostics as well
+    field = mcs.targetPacketFields.index('timestamp')
+    robot = Subscriber("robot", args.port, source, ['Target Info'], field)
+    subscribers = [robot] + [Subscriber("dashboard {}".format(i + 1), args.port, source, ['Target Info', 'Vision Diagnostics'], field)
+                             for i in range(args.dashboards)]
+    deadline = time.perf_counter() + 5
+    while not all(s.instance.isConnected() for s in subscribers):
+        if time.perf_counter() > deadline:
+            sys.exit("the clients could not connect to the server on port {}".format(args.port))
+        time.sleep(0.05)
+
+    print("{:>8}{:>10}{:>10}{:>10}{:>10}{:>8}{:>10}".format("time s", "fps", "p50 ms", "p95 ms", "max ms", "cpu %", "rss MiB"))
+    history = {"time": [], "p50": [], "rss": []}
+    totals = {s.name: LatencyHistogram() for s in subscribers}
+    started = time.perf_counter()
+    lastTime, lastCpu = started, sum(os.times()[:2])
+    try:
+        while time.perf_counter() - started < args.duration:
+            time.sleep(args.interval)
+            now, cpu = time.perf_counter(), sum(os.times()[:2])
+            taken = {s.name: s.take() for s in subscribers}
+            for name, latencies in taken.items():
+                totals[name].add(latencies)
+            # the robot sees one 'target' update per published frame
+            p50, p95, worst = percentiles(taken[robot.name])
+            rss = residentBytes() / 2**20
+            history["time"].append(now - started)
+            history["p50"].append(p50)
+            history["rss"].append(rss)
+            print("{:>8.0f}{:>10.1f}{:>10.2f}{:>10.2f}{:>10.2f}{:>8.0f}{:>10.1f}".format(
+                now - started, len(taken[robot.name]) / (now - lastTime), p50, p95, worst,
+                100 * (cpu - lastCpu) / (now - lastTime), rss), flush=True)
+            lastTime, lastCpu = now, cpu
+    except KeyboardInterrupt:
+        pass
+
+    print()
+    print("{:<14}{:>10}{:>10}{:>10}{:>10}{:>10}".format("client (ms)", "p50", "p95", "p99", "max", "unknown"))
+    for s in subscribers:
+        h = totals[s.name]
+        print("{:<14}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.2f}{:>10}".format(
+            s.name, h.percentile(50), h.percentile(95), h.percentile(99), h.worst * 1000, s.missing))
+    print("vision stages (mean ms): " + ", ".join("{} {:.2f}".format(stage, mean) for stage, (mean, p95) in sorted(stats.summary().items())))
+
+    skip = int(len(history["time"]) * args.warmup)
+    if len(history["time"]) - skip < 10:
+        print("too short a run to judge memory growth or latency drift")
+        return
+    growth = slope(history["time"][skip:], history["rss"][skip:])
+    drift = slope(history["time"][skip:], history["p50"][skip:])
+    print("memory growth: {:+.1f} MiB/h, p50 latency drift: {:+.2f} ms/h".format(growth, drift))
+    failed = []
+    if growth > args.max_growth:
+        failed.append("memory grew {:.1f} MiB/h (limit {})".format(growth, args.max_growth))
+    if drift > args.max_drift:
+        failed.append("latency drifted {:.2f} ms/h (limit {})".format(drift, args.max_drift))
+    if failed:
+        for line in failed:
+            print("  " + line, file=sys.stderr)
+        sys.exit(1)
+    print("no memory growth or latency drift above the limits")
+
+if __name__ == "__main__":
+    main()
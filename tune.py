@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+#----------------------------------------------------------------------------
+# Offline threshold and filter tuner for the vision pipeline.
+#
+# Searches the threshold bounds and the contour filter of a pipeline in
+# pipelineDescriptions for the values that find the labelled targets in a
+# set of frames, on every core of a laptop, and prints them as "vision
+# parameters" for /boot/frc.json along with their accuracy and per-frame
+# cost. Labels are a JSON object from image name (or frame number, for a
+# FrameRecorder recording) to a list of [x, y, w, h] target boxes in pixels;
+# an empty list means the frame has no target, and frames with no entry
+# are left out.
+#
+#   python3 tune.py frames/ labels.json
+#   python3 tune.py vision.rec labels.json --trials 400 --pipeline GripPipeline
+#   python3 tune.py frames/ labels.json --output tuned.json
+#----------------------------------------------------------------------------
+
+import argparse
+import concurrent.futures
+import copy
+import json
+import os
+import statistics
+import sys
+import time
+
+import cv2
+import numpy
+
+from benchmark import imageExtensions, installStubs
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+# filter_contours keys the search changes; the rest only rule out
+# nonsense and are left alone
+filterKeys = ["min_area", "solidity", "min_ratio", "max_ratio"]
+
+def loadLabelled(path, labels):
+    """Returns ([frame], [boxes]) for the labelled frames of an image
+    directory, a single image or a .rec recording."""
+    if path.lower().endswith(".rec"):
+        import multiCameraServer as mcs
+        replay = mcs.ReplaySource(path)
+        names = [n for n in labels if n.isdigit() and int(n) < len(replay)]
+        frames = [numpy.array(replay.record(int(n))[0]) for n in names]
+    else:
+        if os.path.isdir(path):
+            names = sorted(n for n in os.listdir(path) if n.lower().endswith(imageExtensions) and n in labels)
+            files = [os.path.join(path, n) for n in names]
+        else:
+            names = [os.path.basename(path)]
+            files = [path]
+        frames = [cv2.imread(f) for f in files]
+    kept = [(f, labels[n]) for f, n in zip(frames, names) if f is not None]
+    if not kept:
+        sys.exit("no labelled frames could be read from '{}'".format(path))
+    return [f for f, _ in kept], [b for _, b in kept]
+
+def overlap(a, b):
+    """Intersection over union of two (x, y, w, h) boxes."""
+    w = min(a[0] + a[2], b[0] + b[2]) - max(a[0], b[0])
+    h = min(a[1] + a[3], b[1] + b[3]) - max(a[1], b[1])
+    if w <= 0 or h <= 0:
+        return 0.0
+    inter = w * h
+    return inter / float(a[2] * a[3] + b[2] * b[3] - inter)
+
+def match(found, boxes):
+    """How well the best target's (x, y, w, h), or None, matches a frame's
+    boxes: the best overlap, or 1 for nothing found where nothing is."""
+    if found is None:
+        return 0.0 if boxes else 1.0
+    return max([overlap(found, box) for box in boxes], default=0.0)
+
+class Search:
+    """What a worker process keeps between trials: a pipeline to set
+    parameters on, and the frames already at its pyramid scale and in the
+    colour spaces its threshold steps use (see VisionPipeline.convert_frame)."""
+
+    def __init__(self, frames, boxes, description, minOverlap):
+        import multiCameraServer as mcs
+        self.boxes = boxes
+        self.minOverlap = minOverlap
+        self.pipeline = mcs.VisionPipeline(dict(description, tracking=False))
+        self.scale = self.pipeline.pyramid_scale
+        steps = description["steps"]
+        threshold = steps[0]
+        self.thresholdName = threshold.get("name", threshold["step"])
+        self.filterName = next(s for s in steps if s["step"] == "filter_contours").get("name", "filter_contours")
+        self.images = [self.pipeline.convert_frame(frame) for frame in frames]
+
+    def contours(self, thresholds):
+        """Contours of every frame for one set of bounds for the first
+        threshold step, found by the pipeline's own threshold, morphology
+        and find_contours steps."""
+        for channel, bounds in thresholds.items():
+            self.pipeline.set_parameter("{}_{}".format(self.thresholdName, channel), bounds)
+        return [self.pipeline.find_contours(images)[1] for images in self.images]
+
+    def score(self, contours, filters):
+        """(frames right, their summed overlap) with these filter values on
+        already found contours."""
+        for key, value in filters.items():
+            self.pipeline.set_parameter("{}_{}".format(self.filterName, key), value)
+        right = 0
+        fit = 0.0
+        for frame, boxes in zip(contours, self.boxes):
+            best = self.pipeline.filter_contours(frame)[0]
+            found = None
+            if best:
+                found = tuple(v * self.scale for v in cv2.boundingRect(best[0]))
+            m = match(found, boxes)
+            if m >= self.minOverlap:
+                right += 1
+                fit += m
+        return right, fit
+
+search = None
+
+def startWorker(frames, boxes, description, minOverlap):
+    global search
+    installStubs()
+    sys.path.insert(0, here)
+    search = Search(frames, boxes, description, minOverlap)
+
+def trial(thresholds, filterCandidates):
+    """Finds the contours for one set of threshold bounds once, then tries
+    every filter candidate on them. Returns ((frames right, summed
+    overlap), seconds per frame, thresholds, filters) for the best filter;
+    the closer fit wins between equally many frames right, then the cheaper."""
+    start = time.perf_counter()
+    contours = search.contours(thresholds)
+    elapsed = time.perf_counter() - start
+    best = None
+    for filters in filterCandidates:
+        start = time.perf_counter()
+        score = search.score(contours, filters)
+        cost = (elapsed + time.perf_counter() - start) / len(contours)
+        if best is None or better((score, cost), best):
+            best = (score, cost, thresholds, filters)
+    return best
+
+def better(a, b):
+    """Compares (score, cost, ...) trial results."""
+    return (a[0][0], round(a[0][1], 3), -a[1]) > (b[0][0], round(b[0][1], 3), -b[1])
+
+def sampleThresholds(rng, current, spread, channels):
+    """Moves every bound of current by a normal step of spread, in range."""
+    sampled = {}
+    for c in channels:
+        top = 180.0 if c == "hue" else 255.0
+        low, high = numpy.clip(numpy.array(current[c], dtype=float) + rng.normal(0, spread, 2), 0, top)
+        sampled[c] = [round(float(min(low, high)), 1), round(float(max(low, high)), 1)]
+    return sampled
+
+def sampleFilters(rng, current, spread):
+    """Scales sizes and ratios by a log-normal step and moves the solidity
+    range by a normal one, keeping each range in order."""
+    def scaled(value):
+        if value > 0:
+            return float(value * numpy.exp(rng.normal(0, spread)))
+        return float(abs(rng.normal(0, spread * 4)))
+    sampled = {"min_area": round(scaled(current["min_area"]), 1)}
+    solidity = numpy.clip(numpy.array(current["solidity"], dtype=float) + rng.normal(0, spread * 40, 2), 0, 100)
+    sampled["solidity"] = [round(float(min(solidity)), 1), round(float(max(solidity)), 1)]
+    ratios = sorted((scaled(current["min_ratio"]), scaled(current["max_ratio"])))
+    sampled["min_ratio"], sampled["max_ratio"] = round(ratios[0], 3), round(ratios[1], 3)
+    return sampled
+
+def evaluate(mcs, description, parameterSets, frames, boxes, minOverlap):
+    """Runs the whole pipeline with each set of parameters, as the Pi does
+    without a tracking lock. Every pipeline is run over the frames once to
+    warm its buffers and the caches, then they take turns on each frame so
+    none is timed colder than the others.
+    Returns a (frames right, median ms per frame) for each set."""
+    pipelines = []
+    for parameters in parameterSets:
+        pipeline = mcs.createPipeline(dict(description, tracking=False))
+        for key, value in parameters.items():
+            pipeline.set_parameter(key, value)
+        for frame in frames:
+            pipeline.process(frame)
+        pipelines.append(pipeline)
+    right = [0] * len(pipelines)
+    times = [[] for _ in pipelines]
+    for frame, labels in zip(frames, boxes):
+        for i, pipeline in enumerate(pipelines):
+            start = time.perf_counter()
+            x, y, w, h, _ = pipeline.process(frame)
+            times[i].append(time.perf_counter() - start)
+            right[i] += match(None if x == -1 else (x, y, w, h), labels) >= minOverlap
+    return [(right[i], statistics.median(times[i]) * 1000) for i in range(len(pipelines))]
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline threshold and filter tuner")
+    parser.add_argument("source", help="a directory of images, an image or a .rec recording")
+    parser.add_argument("labels", help="JSON object of image name or frame number to [[x, y, w, h], ...]")
+    parser.add_argument("--pipeline", default="GripPipeline2", help="the pipelineDescriptions entry to tune")
+    parser.add_argument("--trials", type=int, default=200, help="threshold candidates per round")
+    parser.add_argument("--filter-trials", type=int, default=40, help="filter candidates tried on each threshold candidate")
+    parser.add_argument("--rounds", type=int, default=3, help="rounds, each searching closer around the best so far")
+    parser.add_argument("--min-overlap", type=float, default=0.5, help="intersection over union a found target needs")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="processes to search on")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the tuned \"vision parameters\" to this JSON file")
+    args = parser.parse_args()
+
+    installStubs()
+    sys.path.insert(0, here)
+    import multiCameraServer as mcs
+
+    with open(args.labels, "rt", encoding="utf-8") as f:
+        labels = {str(k): v for k, v in json.load(f).items()}
+    frames, boxes = loadLabelled(args.source, labels)
+    description = copy.deepcopy(mcs.pipelineDescriptions[args.pipeline])
+    steps = description["steps"]
+    threshold = steps[0]
+    filterStep = next(s for s in steps if s["step"] == "filter_contours")
+    channels = mcs.thresholdSteps[threshold["step"]][0]
+    rng = numpy.random.RandomState(args.seed)
+
+    best = ((-1, 0.0), 0.0, {c: threshold[c] for c in channels}, {k: filterStep[k] for k in filterKeys})
+    started = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(args.workers, initializer=startWorker,
+                                                initargs=(frames, boxes, description, args.min_overlap)) as pool:
+        for n in range(args.rounds):
+            spread = 0.5 ** n
+            # the best so far is always tried again, so a round never makes it worse
+            thresholdCandidates = [best[2]] + [sampleThresholds(rng, best[2], 40 * spread, channels) for i in range(args.trials - 1)]
+            filterCandidates = [best[3]] + [sampleFilters(rng, best[3], 0.5 * spread) for i in range(args.filter_trials - 1)]
+            for result in pool.map(trial, thresholdCandidates, [filterCandidates] * len(thresholdCandidates), chunksize=4):
+                if better(result, best):
+                    best = result
+            print("round {}: {}/{} frames right".format(n + 1, best[0][0], len(frames)))
+    print("searched {} candidates in {:.1f} s".format(args.rounds * args.trials * args.filter_trials, time.perf_counter() - started))
+
+    tuned = {"{}_{}".format(threshold.get("name", threshold["step"]), c): best[2][c] for c in channels}
+    tuned.update({"{}_{}".format(filterStep.get("name", "filter_contours"), k): v for k, v in best[3].items()})
+    before, after = evaluate(mcs, description, [{}, tuned], frames, boxes, args.min_overlap)
+    print("{:<10}{:>12}{:>16}".format("", "accuracy", "ms per frame"))
+    for name, (right, ms) in (("before", before), ("tuned", after)):
+        print("{:<10}{:>11.1f}%{:>16.2f}".format(name, 100.0 * right / len(frames), ms))
+
+    text = json.dumps({"vision parameters": tuned}, indent=4)
+    print(text)
+    if args.output:
+        with open(args.output, "wt", encoding="utf-8") as f:
+            f.write(text + "\n")
+        print("written to '{}'".format(args.output))
+
+if __name__ == "__main__":
+    main()